@@ -35,7 +35,7 @@ import uuid
 import itertools
 import os
 
-from schoollibrary import book, user, busyindicator, network
+from schoollibrary import book, user, busyindicator, network, store
 
 
 class Application(QApplication):
@@ -44,9 +44,17 @@ class Application(QApplication):
     def __init__(self, argv):
         super(Application, self).__init__(argv)
 
+        self.setApplicationName("Schoollibrary")
+
         # Instanciate services.
         self.settings = QSettings("Schoollibrary")
+        self.store = store.CatalogueStore(os.path.join(
+            QDesktopServices.storageLocation(QDesktopServices.DataLocation),
+            "catalogues"))
         self.network = network.NetworkService(self)
+        self.network.setCache(network.ResponseCache(os.path.join(
+            QDesktopServices.storageLocation(QDesktopServices.CacheLocation),
+            "http")))
         self.login = LoginDialog(self)
         self.users = user.UserListModel(self)
         self.books = book.BookTableModel(self)
@@ -76,7 +84,6 @@ class MainWindow(QMainWindow):
     def __init__(self, app):
         super(MainWindow, self).__init__()
         self.app = app
-        self.app.network.finished.connect(self.onNetworkRequestFinished)
 
         self.setWindowTitle("Schulbibliothek")
         self.setWindowIcon(QIcon(self.app.data("schoollibrary.png")))
@@ -120,11 +127,20 @@ class MainWindow(QMainWindow):
             action.setChecked(not hidden)
             self.onColumnVisibilityAction(action)
 
+        # Show the stored catalogue right away and revalidate it.
+        self.app.books.restore()
+
         # Load data.
         self.booksTicket = None
         self.usersTicket = None
         self.onRefreshAction()
 
+        # Follow changes made by other clients.
+        self.app.books.events.start()
+
+        # Report queued lendings that could not be replayed.
+        self.app.books.replayFailed.connect(self.onReplayFailed)
+
     def initTabs(self):
         """Initializes the main tabs."""
         self.tabs = QTabWidget()
@@ -196,6 +212,9 @@ class MainWindow(QMainWindow):
         self.aboutQtAction = QAction(u"Über Qt ...", self)
         self.aboutQtAction.triggered.connect(self.onAboutQtAction)
 
+        self.statisticsAction = QAction("Verbindungsstatistik ...", self)
+        self.statisticsAction.triggered.connect(self.onStatisticsAction)
+
         self.quitAction = QAction("Beenden", self)
         self.quitAction.setShortcut("Ctrl+C")
         self.quitAction.triggered.connect(self.close)
@@ -211,6 +230,11 @@ class MainWindow(QMainWindow):
         self.lendingAction.triggered.connect(self.onLendingAction)
         self.lendingAction.setEnabled(self.app.login.libraryLend)
 
+        self.bulkLendingAction = QAction(u"Sammelausleihe", self)
+        self.bulkLendingAction.setIcon(QIcon(self.app.data("basket-go.png")))
+        self.bulkLendingAction.triggered.connect(self.onBulkLendingAction)
+        self.bulkLendingAction.setEnabled(self.app.login.libraryLend)
+
         self.labelPrintAction = QAction(u"Labels drucken", self)
         self.labelPrintAction.setShortcut("Ctrl+P")
         self.labelPrintAction.triggered.connect(self.onLabelPrintAction)
@@ -277,6 +301,7 @@ class MainWindow(QMainWindow):
         """Creates the main menu."""
         mainMenu = self.menuBar().addMenu("Bibliothek")
         mainMenu.addAction(self.refreshAction)
+        mainMenu.addAction(self.statisticsAction)
         mainMenu.addSeparator()
         mainMenu.addAction(self.aboutAction)
         mainMenu.addAction(self.aboutQtAction)
@@ -287,6 +312,7 @@ class MainWindow(QMainWindow):
         bookMenu.addAction(self.addBookAction)
         bookMenu.addSeparator()
         bookMenu.addAction(self.lendingAction)
+        bookMenu.addAction(self.bulkLendingAction)
         bookMenu.addAction(self.searchBooksAction)
         bookMenu.addSeparator()
         bookMenu.addAction(self.labelPrintAction)
@@ -303,6 +329,7 @@ class MainWindow(QMainWindow):
 
         self.contextMenu = QMenu()
         self.contextMenu.addAction(self.lendingAction)
+        self.contextMenu.addAction(self.bulkLendingAction)
         self.contextMenu.addSeparator()
         self.contextMenu.addAction(self.labelPrintAction)
         self.contextMenu.addSeparator()
@@ -311,9 +338,60 @@ class MainWindow(QMainWindow):
 
     def onRefreshAction(self):
         """Handles the refresh action."""
-        self.showBusyIndicator(True)
-        self.usersTicket = self.app.users.reload()
-        self.booksTicket = self.app.books.reload()
+        # Books that are already shown stay usable while refreshing.
+        self.showBusyIndicator(not self.app.books.rowCount())
+        self.usersTicket = self.app.users.reload(self.onReloadFinished)
+        self.booksTicket = self.app.books.reload(self.onReloadFinished)
+
+    def onStatisticsAction(self):
+        """Shows the connection statistics, with those of the server for admins."""
+        if self.app.login.libraryAdmin:
+            request = network.uncached(QNetworkRequest(self.app.login.getUrl("/stats")))
+            self.app.network.http("GET", request, callback=self.onStatisticsFinished, priority=network.Interactive)
+        else:
+            self.showStatistics(None)
+
+    def onStatisticsFinished(self, reply):
+        server = None
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) == 200:
+            server = json.loads(reply.readAll().data())
+        self.showStatistics(server)
+
+    def showStatistics(self, server):
+        stats = self.app.network.stats
+        lines = [
+            "Anfragen: %d" % stats["requests"],
+            "Davon per Pipelining: %d" % stats["pipelined"],
+            "Davon aus dem Cache: %d" % stats["fromCache"],
+            "Gesendet: %.1f KiB" % (stats["bytesSent"] / 1024.0),
+            "Empfangen: %.1f KiB" % (stats["bytesReceived"] / 1024.0),
+            "",
+            "Antwortzeiten:",
+        ]
+
+        bounds = ["< %d ms" % (bound * 1000) for bound in network.LATENCY_BUCKETS]
+        bounds.append(">= %d ms" % (network.LATENCY_BUCKETS[-1] * 1000))
+        for bound, count in zip(bounds, self.app.network.latencies):
+            lines.append("  %s: %d" % (bound, count))
+
+        if server:
+            lines += [
+                "",
+                "Server:",
+                u"Geöffnete Verbindungen: %d" % server["connections"],
+                "Offene Verbindungen: %d" % server["open"],
+                "Anfragen: %d" % server["requests"],
+                "Keep-Alive-Timeout: %d s" % (server["keepAliveTimeout"] // 1000),
+                u"Geschlossene Verbindungen nach Anfragen:",
+            ]
+            for bucket in sorted(server["requestsPerConnection"], key=int):
+                count = server["requestsPerConnection"][bucket]
+                if int(bucket) > 1:
+                    lines.append("  %d-%d: %d" % (int(bucket), int(bucket) * 2 - 1, count))
+                else:
+                    lines.append("  %d: %d" % (int(bucket), count))
+
+        QMessageBox.information(self, "Verbindungsstatistik", "\n".join(lines))
 
     def onAboutAction(self):
         """Handles the about action."""
@@ -337,6 +415,12 @@ class MainWindow(QMainWindow):
         for currentBook in self.selectedBooks(20):
             book.LendingDialog.open(self.app, currentBook, self)
 
+    def onBulkLendingAction(self):
+        """Handles the bulk lending action."""
+        books = self.selectedBooks()
+        if books:
+            book.BulkLendingDialog(self.app, books, self).show()
+
     def onEditBookAction(self):
         """Handles the edit book action."""
         for currentBook in self.selectedBooks(20):
@@ -477,8 +561,8 @@ class MainWindow(QMainWindow):
                 self.onTabVisibilityAction(action)
                 break
 
-    def onNetworkRequestFinished(self, reply):
-        """Called when a network request is finished."""
+    def onReloadFinished(self, reply):
+        """Called when a reload request is finished."""
         if reply.request().attribute(network.Ticket) == self.booksTicket:
             self.booksTicket = None
 
@@ -488,6 +572,20 @@ class MainWindow(QMainWindow):
         if not self.booksTicket and not self.usersTicket:
             self.showBusyIndicator(False)
 
+    def onReplayFailed(self, id, status):
+        """Called when the server rejects a queued lending or return."""
+        if status == 409:
+            message = u"Das Buch %d wurde zwischenzeitlich geändert." % id
+        elif status == 412:
+            message = u"Das Buch %d ist bereits an jemand anderen ausgeliehen." % id
+        elif status == 404:
+            message = u"Das Buch %d ist nicht mehr vorhanden oder bereits zurückgegeben." % id
+        else:
+            message = u"Das Buch %d konnte nicht aktualisiert werden (HTTP Status Code: %d)." % (id, status)
+
+        QMessageBox.warning(self, self.windowTitle(),
+            message + u" Die offline gespeicherte Ausleihe oder Rücknahme wurde verworfen.")
+
     def closeEvent(self, event):
         """Saves the geometry when the window is closed."""
         self.app.settings.setValue("MainWindowGeometry", self.saveGeometry())
@@ -504,7 +602,6 @@ class LoginDialog(QDialog):
     def __init__(self, app, parent=None):
         super(LoginDialog, self).__init__(parent)
         self.app = app
-        self.app.network.finished.connect(self.onNetworkRequestFinished)
 
         self.setWindowTitle("Schulbibliothek Login")
         self.setWindowIcon(QIcon(self.app.data("schoollibrary.png")))
@@ -570,22 +667,13 @@ class LoginDialog(QDialog):
         return widget
 
     def getUrl(self, path=None):
-        """Gets a URL with the settings chosen in the dialog."""
-        url = QUrl(self.urlBox.text())
-        url.setUserName(self.userNameBox.text())
-        url.setPassword(self.passwordBox.text())
-
-        basepath = url.path()
-        if basepath.endswith("/"):
-            basepath = basepath[:-1]
-
-        if path:
-            url.setPath(basepath + path)
-
-        return url
+        """Gets a URL on the server of the session."""
+        return self.app.network.session.url(path)
 
     def onAccept(self):
         """Sends a login request to the service."""
+        self.app.network.session = network.Session(
+            self.urlBox.text(), self.userNameBox.text(), self.passwordBox.text())
         url = self.getUrl("/")
 
         if not url.isValid():
@@ -595,21 +683,19 @@ class LoginDialog(QDialog):
         self.layoutStack.setCurrentIndex(1)
         self.busyIndicator.setEnabled(True)
 
-        self.ticket = self.app.network.http("GET", QNetworkRequest(url))
+        self.ticket = self.app.network.http("GET", QNetworkRequest(url), callback=self.onLoginFinished)
 
     def onCancel(self):
         self.layoutStack.setCurrentIndex(0)
         self.busyIndicator.setEnabled(False)
+        self.app.network.release(self.ticket)
         self.ticket = None
 
-    def onNetworkRequestFinished(self, reply):
+    def onLoginFinished(self, reply):
         """Handles responses to the login request."""
-        # Ensure the reply is meant for this dialog.
-        if reply.request().attribute(network.Ticket) != self.ticket:
-            return
-        else:
-            self.busyIndicator.setEnabled(False)
-            self.layoutStack.setCurrentIndex(0)
+        self.ticket = None
+        self.busyIndicator.setEnabled(False)
+        self.layoutStack.setCurrentIndex(0)
 
         # Check for an authentication error.
         if reply.error() == QNetworkReply.AuthenticationRequiredError:
@@ -24,13 +24,16 @@ from PySide.QtCore import *
 from PySide.QtGui import *
 from PySide.QtNetwork import *
 
+import functools
 import json
+import operator
 import uuid
 import re
 import datetime
+import struct
 import dateutil.parser
 
-from schoollibrary import indexed, busyindicator, network, printpreview
+from schoollibrary import indexed, busyindicator, network, printpreview, search, store, stream, user
 
 
 def normalize_isbn(isbn):
@@ -69,9 +72,23 @@ def normalize_isbn(isbn):
         raise ValueError("Invalid ISBN.")
 
 
+_strings = {}
+
+def intern_string(value):
+    """Shares equal strings, for values that repeat across many books."""
+    return _strings.setdefault(value, value)
+
+
 class Book(object):
     """A book object."""
 
+    __slots__ = [
+        "id", "etag", "signature", "location", "title", "authors", "topic",
+        "volume", "keywords", "publisher", "placeOfPublication", "year",
+        "isbn", "edition", "lendable", "lendingUser", "lendingSince",
+        "lendingDays", "lendingState", "lent",
+    ]
+
     def __init__(self):
         self.id = 0
         self.etag = 0
@@ -91,26 +108,336 @@ class Book(object):
         self.lendingUser = None
         self.lendingSince = None
         self.lendingDays = None
+        self.lendingState = None
         self.lent = False
 
+    def setLending(self, user=None, since=None, days=None):
+        """Sets or clears the lending. since is given as an ISO date string."""
+        self.lendingUser = intern_string(user) if user else user
+        self.lendingSince = dateutil.parser.parse(since).date() if since else None
+        self.lendingDays = days
+        self.lendingState = None
+
+    def lendingStatus(self):
+        """Gets the number of days the book is lent and if it is overdue."""
+        today = datetime.date.today()
+        if self.lendingState is None or self.lendingState[0] != today:
+            duration = (today - self.lendingSince).days
+            self.lendingState = today, duration, duration > self.lendingDays
+        return self.lendingState[1:]
+
+
+# Number of books per page of the full book list.
+BOOK_PAGE_SIZE = 2000
+
+def book_from_data(data):
+    """Builds a book from its JSON representation."""
+    book = Book()
+
+    book.id = int(data["_id"])
+    book.etag = data["etag"]
+    book.isbn = data["isbn"]
+    book.title = data["title"]
+    book.authors = data["authors"]
+    book.volume = intern_string(data["volume"])
+    book.edition = intern_string(data["edition"])
+    book.topic = intern_string(data["topic"])
+    book.keywords = data["keywords"]
+    book.signature = data["signature"]
+    book.location = intern_string(data["location"])
+    book.year = int(data["year"]) if data["year"] else None
+    book.publisher = intern_string(data["publisher"])
+    book.placeOfPublication = intern_string(data["placeOfPublication"])
+    book.lendable = bool(data["lendable"])
+    book.lent = bool(data["lent"])
+
+    if book.lent and "lending" in data:
+        book.setLending(data["lending"]["user"], data["lending"]["since"], data["lending"]["days"])
+
+    return book
+
+
+def book_to_row(book):
+    """Gets the row of a book for the catalogue store."""
+    return (
+        book.id, book.etag, book.signature, book.location, book.title,
+        book.authors, book.topic, book.volume, book.keywords, book.publisher,
+        book.placeOfPublication, book.year, book.isbn, book.edition,
+        book.lendable, book.lent, book.lendingUser,
+        book.lendingSince.toordinal() if book.lendingSince else None,
+        book.lendingDays)
+
+
+class StoredBook(Book):
+    """
+    A book of a stored catalogue. Text fields are read from the catalogue
+    file when they are accessed, unless they have been assigned.
+    """
+
+    __slots__ = ["catalogue", "row"]
+
+    def __init__(self, catalogue, row):
+        self.catalogue = catalogue
+        self.row = row
+
+        self.id = catalogue.value(row, "id")
+        self.etag = catalogue.value(row, "etag")
+        self.year = catalogue.value(row, "year")
+        self.lendable = bool(catalogue.value(row, "lendable"))
+        self.lent = bool(catalogue.value(row, "lent"))
+        lendingSince = catalogue.value(row, "lendingSince")
+        self.lendingSince = datetime.date.fromordinal(lendingSince) if lendingSince else None
+        self.lendingDays = catalogue.value(row, "lendingDays")
+        self.lendingState = None
+
+    def __getattr__(self, name):
+        if name in store.STRING_COLUMNS:
+            value = self.catalogue.value(self.row, name)
+            return (value or None) if name == "lendingUser" else value
+
+        raise AttributeError(name)
+
+
+def stored_haystacks(catalogue):
+    """Reads the haystacks of all books of a stored catalogue in bulk."""
+    columns = [catalogue.strings(field) for field in search.HAYSTACK_FIELDS]
+    users = catalogue.strings("lendingUser")
+    return [search.join_haystack(fields, user) for fields, user in zip(zip(*columns), users)]
+
+
+class BookCache(indexed.IndexedOrderedDict):
+    """
+    Books by id, in the order of the table. Books of a stored catalogue are
+    only created when they are accessed. Until then their row in the
+    catalogue is kept.
+    """
+
+    def __init__(self, *args, **kwds):
+        self.catalogue = None
+        super(BookCache, self).__init__(*args, **kwds)
+
+    def restore(self, catalogue):
+        """Replaces all books with the books of a stored catalogue."""
+        self.clear()
+        self.catalogue = catalogue
+        self.extend(catalogue.column("id"), range(len(catalogue)))
+
+    def clear(self):
+        super(BookCache, self).clear()
+        self.catalogue = None
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value.__class__ is int:
+            value = StoredBook(self.catalogue, value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def idAt(self, row):
+        """Gets the id of the book at a position."""
+        return self._keyAt(row)
+
+    def bookAt(self, row):
+        """Gets the book at a position."""
+        return self[self._keyAt(row)]
+
+    def lentAt(self, row):
+        """Checks if the book at a position is lent, without creating it."""
+        value = dict.__getitem__(self, self._keyAt(row))
+        if value.__class__ is int:
+            return bool(self.catalogue.value(value, "lent"))
+        return value.lent
+
+    def column(self, name):
+        """Gets a field of all books, in order. Text is read in bulk."""
+        strings = None
+        values = []
+        for key in self:
+            value = dict.__getitem__(self, key)
+            if value.__class__ is int:
+                if strings is None:
+                    strings = self.catalogue.strings(name)
+                values.append(strings[value])
+            else:
+                values.append(getattr(value, name))
+        return values
+
+    def rows(self):
+        """Gets the rows of all books for the catalogue store, in order."""
+        stored = None
+        rows = []
+        for key in self:
+            value = dict.__getitem__(self, key)
+            if value.__class__ is int:
+                if stored is None:
+                    stored = self.catalogue.rows()
+                rows.append(stored[value])
+            else:
+                rows.append(book_to_row(value))
+        return rows
+
+
+class BookDecoder(QObject):
+    """Decodes full book lists on a worker thread."""
+
+    decoded = Signal(str, object, bool)
+    failed = Signal(str)
+
+    def __init__(self):
+        super(BookDecoder, self).__init__()
+        self.streams = {}
+
+    @Slot(str, QByteArray)
+    def feed(self, ticket, data):
+        """Decodes a chunk and emits the books that are complete."""
+        try:
+            members = self.streams.setdefault(ticket, stream.JsonObjectStream()).feed(data.data())
+            books = [book_from_data(value) for key, value in members]
+        except (ValueError, KeyError):
+            self.streams.pop(ticket, None)
+            self.failed.emit(ticket)
+        else:
+            if books:
+                self.decoded.emit(ticket, books, False)
+
+    @Slot(str)
+    def finish(self, ticket):
+        """Checks the end of a book list."""
+        try:
+            self.streams.pop(ticket, stream.JsonObjectStream()).finish()
+        except ValueError:
+            self.failed.emit(ticket)
+        else:
+            self.decoded.emit(ticket, [], True)
+
+
+def lendingText(book):
+    """Describes the lending of a book for the table."""
+    if book.lent:
+        if book.lendingUser:
+            duration, overdue = book.lendingStatus()
+            if duration == 0:
+                return "%s seit heute" % (book.lendingUser)
+            elif duration == 1:
+                return "%s seit gestern" % (book.lendingUser)
+            else:
+                return "%s seit %d Tagen" % (book.lendingUser, duration)
+        return "Ja"
+
+
+COLUMN_HEADERS = [
+    "ID", "ETag", "Signatur", "Standort", "Titel", "Autoren", "Thema", "Band",
+    u"Schlüsselwörter", "Verlag", u"Veröffentlichungsort", "Jahr", "ISBN",
+    "Ausgabe", "Ausleihbar", "Ausgeliehen",
+]
+
+COLUMN_DISPLAY = [
+    operator.attrgetter("id"),
+    operator.attrgetter("etag"),
+    operator.attrgetter("signature"),
+    operator.attrgetter("location"),
+    operator.attrgetter("title"),
+    operator.attrgetter("authors"),
+    operator.attrgetter("topic"),
+    operator.attrgetter("volume"),
+    operator.attrgetter("keywords"),
+    operator.attrgetter("publisher"),
+    operator.attrgetter("placeOfPublication"),
+    operator.attrgetter("year"),
+    operator.attrgetter("isbn"),
+    operator.attrgetter("edition"),
+    lambda book: "Ja" if book.lendable else "Nein",
+    lendingText,
+]
+
+COLUMN_SORT_KEY = COLUMN_DISPLAY[:14] + [
+    lambda book: 1 if book.lendable else 0,
+    lambda book: book.lendingUser or book.lent,
+]
+
+COLUMN_CENTERED = frozenset([0, 1, 2, 11, 14])
+
+COLUMN_EDIT = frozenset([3, 12])
+
 
 class BookTableModel(QAbstractTableModel):
     """The book database."""
 
+    decodeRequested = Signal(str, QByteArray)
+    decodeFinished = Signal(str)
+
+    # A queued lending or return was rejected: book id, HTTP status code.
+    replayFailed = Signal(int, int)
+
     def __init__(self, app):
         super(BookTableModel, self).__init__()
         self.app = app
-        self.app.network.finished.connect(self.onNetworkRequestFinished)
-        self.cache = indexed.IndexedOrderedDict()
-
-        self.bookPathPattern = re.compile(r".*\/books\/([0-9]+)\/$")
-        self.lendingPathPattern = re.compile(r".*\/books\/([0-9]+)\/lending$")
+        self.cache = BookCache()
+        self.searchIndex = search.SearchIndex()
+        self.revision = None
+
+        # Revision of the catalogue in the store.
+        self.stored = None
+
+        # The full book list is downloaded in pages, that are decoded on a
+        # worker thread while they are being downloaded.
+        self.streamTicket = None
+        self.streamStarted = False
+        self.streamRevision = None
+        self.streamAfter = None
+        self.streamLast = None
+        self.streamCount = 0
+        self.decoder = BookDecoder()
+        self.decoderThread = QThread()
+        self.decoder.moveToThread(self.decoderThread)
+        self.decodeRequested.connect(self.decoder.feed)
+        self.decodeFinished.connect(self.decoder.finish)
+        self.decoder.decoded.connect(self.onBooksDecoded)
+        self.decoder.failed.connect(self.onBooksDecodingFailed)
+        self.decoderThread.start()
+        self.app.aboutToQuit.connect(self.onAboutToQuit)
+
+        # Changes by other clients are pushed by the server.
+        self.events = self.app.network.subscribe("/events")
+        self.events.received.connect(self.onEvent)
+        self.events.connected.connect(self.onEventsConnected)
+        self.eventsMissed = False
+
+        # Lendings and returns are queued in a journal while the server is
+        # unreachable, applied locally and sent in order later.
+        self.journal = None
+        self.queue = []
+        self.replayTicket = None
+        self.replayEntry = None
+        self.replayTimer = QTimer(self)
+        self.replayTimer.setSingleShot(True)
+        self.replayTimer.setInterval(30000)
+        self.replayTimer.timeout.connect(self.replay)
+
+        # Lendings and returns are shown before the server confirms them.
+        # The previous state of the book is kept by ticket for rolling
+        # back. Books whose change was rejected are marked.
+        self.pending = {}
+        self.conflicts = set()
+
+        # Callbacks of entries that were queued while online, by entry.
+        self.queueCallbacks = {}
+
+        self.titleFont = QFont()
+        self.titleFont.setBold(True)
+        self.overdueColor = QColor(231, 76, 60)
+        self.lentColor = QColor(46, 204, 113)
+        self.notLendableColor = QColor(236, 240, 241)
+        self.conflictColor = QColor(243, 156, 18)
 
     def index(self, row, column, parent=QModelIndex()):
         if parent.isValid() or not self.hasIndex(row, column, parent):
             return QModelIndex()
         else:
-            return self.createIndex(row, column, self.cache.values()[row])
+            return self.createIndex(row, column, row)
 
     def rowCount(self, parent=QModelIndex()):
         return len(self.cache)
@@ -119,254 +446,649 @@ class BookTableModel(QAbstractTableModel):
         return 16
 
     def data(self, index, role=Qt.DisplayRole):
-        book = index.internalPointer()
+        column = index.column()
+
+        # Sorting by id does not need to create stored books.
+        if role == Qt.UserRole and column == 0:
+            return self.cache.idAt(index.row())
+
+        book = self.cache.bookAt(index.row())
 
         if role == Qt.DisplayRole:
-            if index.column() == 0:
-                return book.id
-            elif index.column() == 1:
-                return book.etag
-            elif index.column() == 2:
-                return book.signature
-            elif index.column() == 3:
-                return book.location
-            elif index.column() == 4:
-                return book.title
-            elif index.column() == 5:
-                return book.authors
-            elif index.column() == 6:
-                return book.topic
-            elif index.column() == 7:
-                return book.volume
-            elif index.column() == 8:
-                return book.keywords
-            elif index.column() == 9:
-                return book.publisher
-            elif index.column() == 10:
-                return book.placeOfPublication
-            elif index.column() == 11:
-                return book.year
-            elif index.column() == 12:
-                return book.isbn
-            elif index.column() == 13:
-                return book.edition
-            elif index.column() == 14:
-                return "Ja" if book.lendable else "Nein"
-            elif index.column() == 15:
-                if book.lent:
-                    if book.lendingUser:
-                        today = datetime.date.today()
-                        since = dateutil.parser.parse(book.lendingSince).date()
-                        duration = (today - since).days
-                        if duration == 0:
-                            return "%s seit heute" % (book.lendingUser)
-                        elif duration == 1:
-                            return "%s seit gestern" % (book.lendingUser)
-                        else:
-                            return "%s seit %d Tagen" % (book.lendingUser, duration)
-                    return "Ja"
-        elif role == Qt.EditRole:
-            if index.column() == 3:
-                return book.location
-            elif index.column() == 12:
-                return book.isbn
+            return COLUMN_DISPLAY[column](book)
         elif role == Qt.UserRole:
-            if index.column() == 14:
-                return 1 if book.lendable else 0
-            elif index.column() == 15:
-                if book.lendingUser:
-                    return book.lendingUser
-                else:
-                    return book.lent
-            else:
-                return index.data(Qt.DisplayRole)
-        elif role == Qt.TextAlignmentRole:
-            if index.column() in (0, 1, 2, 11, 14):
-                return Qt.AlignCenter
-        elif role == Qt.FontRole:
-            if index.column() == 4:
-                font = QFont()
-                font.setBold(True)
-                return font
+            return COLUMN_SORT_KEY[column](book)
         elif role == Qt.BackgroundRole:
-            if book.lent:
+            if book.id in self.conflicts:
+                return self.conflictColor
+            elif book.lent:
                 if book.lendingUser:
                     # Highlight red if overdue.
-                    today = datetime.date.today()
-                    since = dateutil.parser.parse(book.lendingSince).date()
-                    days = datetime.timedelta(days=book.lendingDays)
-                    if today - since > days:
-                        return QColor(231, 76, 60)
-                return QColor(46, 204, 113)
+                    duration, overdue = book.lendingStatus()
+                    if overdue:
+                        return self.overdueColor
+                return self.lentColor
             elif not book.lendable:
-                return QColor(236, 240, 241)
+                return self.notLendableColor
+        elif role == Qt.TextAlignmentRole:
+            if column in COLUMN_CENTERED:
+                return Qt.AlignCenter
+        elif role == Qt.FontRole:
+            if column == 4:
+                return self.titleFont
+        elif role == Qt.EditRole:
+            if column in COLUMN_EDIT:
+                return COLUMN_DISPLAY[column](book)
+        elif role == Qt.ToolTipRole:
+            if book.id in self.conflicts:
+                return u"Die letzte Ausleihe oder Rücknahme wurde abgelehnt."
 
     def headerData(self, section, orientation, role=Qt.DisplayRole):
-        if orientation == Qt.Horizontal:
-            if role == Qt.DisplayRole:
-                if section == 0:
-                    return "ID"
-                if section == 1:
-                    return "ETag"
-                elif section == 2:
-                    return "Signatur"
-                elif section == 3:
-                    return "Standort"
-                elif section == 4:
-                    return "Titel"
-                elif section == 5:
-                    return "Autoren"
-                elif section == 6:
-                    return "Thema"
-                elif section == 7:
-                    return "Band"
-                elif section == 8:
-                    return u"Schlüsselwörter"
-                elif section == 9:
-                    return "Verlag"
-                elif section == 10:
-                    return u"Veröffentlichungsort"
-                elif section == 11:
-                    return "Jahr"
-                elif section == 12:
-                    return "ISBN"
-                elif section == 13:
-                    return "Ausgabe"
-                elif section == 14:
-                    return "Ausleihbar"
-                elif section == 15:
-                    return "Ausgeliehen"
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            if 0 <= section < len(COLUMN_HEADERS):
+                return COLUMN_HEADERS[section]
+
+    def reload(self, callback=None):
+        # Load the full list, if the cache is not yet populated.
+        if self.revision is None:
+            # Cancel the list that is being loaded.
+            if self.streamTicket:
+                self.app.network.abort(self.streamTicket)
+                self.decodeFinished.emit(self.streamTicket)
+
+            self.streamStarted = False
+            self.streamRevision = None
+            return self.requestPage(None, callback)
+
+        # Otherwise only ask for changes. The server answers 304 if the
+        # catalogue revision did not change.
+        url = self.app.login.getUrl("/books/")
+        url.addQueryItem("since", str(self.revision))
+
+        request = network.uncached(QNetworkRequest(url))
+        request.setRawHeader(QByteArray("If-None-Match"), QByteArray("\"%d\"" % self.revision))
+        return self.app.network.http("GET", request, callback=network.chain(self.onBooksReply, callback))
+
+    def requestPage(self, after, callback=None):
+        """Requests the page of the full book list following the given id."""
+        url = self.app.login.getUrl("/books/")
+        url.addQueryItem("limit", str(BOOK_PAGE_SIZE))
+        if after is not None:
+            url.addQueryItem("after", str(after))
+
+        # Insert books as they arrive.
+        request = network.uncached(QNetworkRequest(url))
+        ticket = self.app.network.http("GET", request, callback=network.chain(self.onBooksReply, callback),
+                                       readyRead=self.onBooksReadyRead)
+        self.streamTicket = ticket
+        self.streamAfter = after
+        self.streamLast = after
+        self.streamCount = 0
+
+        return ticket
+
+    def fetch(self, book, callback=None):
+        """Loads a single book."""
+        path = "/books/%d/" % book.id
+        request = QNetworkRequest(self.app.login.getUrl(path))
+        handler = functools.partial(self.onBookReply, book.id)
+        return self.app.network.http("GET", request, callback=network.chain(handler, callback),
+                                     priority=network.Interactive)
+
+    def onBooksReadyRead(self, reply):
+        """Passes the data received so far to the decoder."""
+        ticket = reply.request().attribute(network.Ticket)
+        if ticket != self.streamTicket:
+            return
 
-    def reload(self):
-        # Calculate checksum over all books.
-        etag = 0
-        for book in self.cache.values():
-            etag ^= book.etag
-
-        # Send reload request.
-        request = QNetworkRequest(self.app.login.getUrl("/books/"))
-        if etag:
-            request.setRawHeader(QByteArray("If-None-Match"), QByteArray(str(etag)))
-        return self.app.network.http("GET", request)
-
-    def delete(self, book):
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) != 200:
+            return
+
+        self.decodeRequested.emit(ticket, reply.readAll())
+
+    def onBooksDecoded(self, ticket, books, done):
+        """Inserts a batch of books from the decoder."""
+        if ticket != self.streamTicket:
+            return
+
+        # Start over with the first batch.
+        if not self.streamStarted:
+            self.streamStarted = True
+            self.beginResetModel()
+            self.cache.clear()
+            self.searchIndex.clear()
+            self.endResetModel()
+
+        if books:
+            self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount() + len(books) - 1)
+            for book in books:
+                self.cache[book.id] = book
+                self.searchIndex.add(book)
+            self.endInsertRows()
+
+            self.streamCount += len(books)
+            last = max(book.id for book in books)
+            if self.streamLast is None or last > self.streamLast:
+                self.streamLast = last
+
+        if done:
+            if self.streamCount == BOOK_PAGE_SIZE:
+                # A full page. Continue after the highest id so far.
+                self.requestPage(self.streamLast)
+            else:
+                # Changes made while paging will be in the next delta.
+                self.revision = self.streamRevision
+                self.streamTicket = None
+
+                if self.eventsMissed and self.revision is not None:
+                    self.eventsMissed = False
+                    self.reload()
+
+                self.applyQueue()
+
+    def onBooksDecodingFailed(self, ticket):
+        if ticket == self.streamTicket:
+            self.streamTicket = None
+
+    def onEventsConnected(self):
+        """Catches up with changes made while not subscribed."""
+        # The server is reachable again.
+        self.replay()
+
+        if self.streamTicket:
+            self.eventsMissed = True
+        elif self.revision is not None:
+            self.reload()
+
+    def onEvent(self, event, data):
+        """Applies a change pushed by the server."""
+        # The full list is still loading. Catch up with a delta later.
+        if self.streamTicket or self.revision is None:
+            self.eventsMissed = True
+            return
+
+        data = json.loads(data)
+        if event == "book":
+            self.updateBook(book_from_data(data["book"]))
+        elif event == "delete":
+            self.removeBook(int(data["id"]))
+        else:
+            return
+
+        # Only advance without gaps, so that deltas cannot miss changes.
+        if data["revision"] in (self.revision, self.revision + 1):
+            self.revision = data["revision"]
+
+    def storeKey(self):
+        """Gets the key of the catalogue in the store: server and user."""
+        return self.app.login.getUrl("/books/").toString(QUrl.RemovePassword)
+
+    def restore(self):
+        """Populates the cache from the store. A reload then fetches only the changes."""
+        self.journal = self.app.store.journal(self.storeKey())
+        try:
+            self.queue = self.journal.load()
+        except EnvironmentError:
+            self.queue = []
+
+        try:
+            catalogue = self.app.store.load(self.storeKey())
+        except (ValueError, struct.error, EnvironmentError):
+            return
+
+        if catalogue is None:
+            return
+
+        # Text is only read for books that are shown or searched.
+        self.beginResetModel()
+        self.cache.restore(catalogue)
+        self.searchIndex.clear()
+        self.searchIndex.defer(catalogue.column("id"), catalogue.column("year"),
+                               functools.partial(stored_haystacks, catalogue))
+        self.endResetModel()
+
+        self.revision = self.stored = catalogue.revision
+        self.applyQueue()
+
+    def persist(self):
+        """Writes the cache to the store, if it is consistent and changed."""
+        if self.revision is None or self.streamTicket:
+            return
+
+        # Lendings and returns that the server has not confirmed are shown,
+        # but are not journaled, so a delta would never correct them.
+        if self.pending:
+            return
+
+        if self.stored == self.revision:
+            return
+
+        try:
+            self.app.store.save(self.storeKey(), self.revision, self.cache.rows())
+        except EnvironmentError:
+            return
+
+        self.stored = self.revision
+
+    def onAboutToQuit(self):
+        self.persist()
+        self.decoderThread.quit()
+        self.decoderThread.wait()
+
+    def save(self, book, params, callback=None):
+        """Creates a new book or updates an existing one."""
+        if not book.id:
+            request = QNetworkRequest(self.app.login.getUrl("/books/"))
+            request.setHeader(QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded")
+            return self.app.network.http("POST", request, params.encodedQuery(), network.chain(self.onBookCreated, callback))
+        else:
+            path = "/books/%d/" % book.id
+            request = QNetworkRequest(self.app.login.getUrl(path))
+            request.setHeader(QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded")
+            handler = functools.partial(self.onBookReply, book.id)
+            return self.app.network.http("PUT", request, params.encodedQuery(), network.chain(handler, callback))
+
+    def delete(self, book, callback=None):
         path = "/books/%d/" % book.id
         request = QNetworkRequest(self.app.login.getUrl(path))
         request.setRawHeader(QByteArray("X-CSRF-Token"), QByteArray(self.app.login.csrf))
-        return self.app.network.http("DELETE", request)
+        handler = functools.partial(self.onBookReply, book.id)
+        return self.app.network.http("DELETE", request, callback=network.chain(handler, callback))
+
+    def lend(self, book, user, days, callback=None):
+        """Lends a book. Gets None, if it was queued, because the server is unreachable."""
+        return self.submitLending(self.lendingEntry(book, "lend", user, days), callback)
+
+    def returnBook(self, book, callback=None):
+        """Returns a book. Gets None, if it was queued, because the server is unreachable."""
+        return self.submitLending(self.lendingEntry(book, "return"), callback)
+
+    def lendingEntry(self, book, action, user=None, days=None):
+        # Follow-up entries for a book are checked against the etag that
+        # replaying the previous one yields.
+        queued = self.isPending(book.id) or any(entry["id"] == book.id for entry in self.queue)
+        return {
+            "id": book.id,
+            "action": action,
+            "user": user,
+            "days": days,
+            "etag": None if queued else book.etag,
+        }
+
+    def submitLending(self, entry, callback):
+        # Keep the order while offline or while the book has a pending change.
+        if self.queue or self.isPending(entry["id"]):
+            self.enqueue(entry, callback=callback)
+            return None
+
+        handler = functools.partial(self.onLendingSent, entry)
+        ticket = self.sendLending(entry, network.chain(handler, callback))
+
+        # Show the change right away.
+        if entry["id"] in self.cache:
+            book = self.cache[entry["id"]]
+            self.pending[ticket] = entry, (book.lent, book.lendingUser, book.lendingSince, book.lendingDays)
+            self.applyEntry(book, entry)
+            self.refreshBook(book)
+
+        return ticket
+
+    def isPending(self, id):
+        return any(entry["id"] == id for entry, lending in self.pending.values())
+
+    def sendLending(self, entry, callback):
+        """Sends a lending or return. The server answers 409 if the etag changed."""
+        etag = entry["etag"]
+        if etag is None and entry["id"] in self.cache:
+            etag = self.cache[entry["id"]].etag
 
-    def onNetworkRequestFinished(self, reply):
+        url = self.app.login.getUrl("/books/%d/lending" % entry["id"])
+
+        if entry["action"] == "lend":
+            params = QUrl()
+            params.addQueryItem("_csrf", self.app.login.csrf)
+            params.addQueryItem("user", entry["user"])
+            params.addQueryItem("days", str(entry["days"]))
+            params.addQueryItem("etag", str(etag))
+
+            request = QNetworkRequest(url)
+            request.setHeader(QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded")
+            return self.app.network.http("POST", request, params.encodedQuery(), callback)
+        else:
+            url.addQueryItem("etag", str(etag))
+
+            request = QNetworkRequest(url)
+            request.setRawHeader(QByteArray("X-CSRF-Token"), QByteArray(self.app.login.csrf))
+            return self.app.network.http("DELETE", request, callback=callback)
+
+    def onLendingSent(self, entry, reply):
+        entry, lending = self.pending.pop(reply.request().attribute(network.Ticket), (entry, None))
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+
+        if status is None:
+            # The server is unreachable. Entries for the same book have been
+            # queued after this one was sent, so it goes first.
+            self.enqueue(entry, True)
+        elif status in (200, 204):
+            self.onLendingReply(entry["id"], reply)
+            self.replay()
+        else:
+            self.rollBack(entry, lending)
+            self.replay()
+
+    def rollBack(self, entry, lending):
+        """Restores the state of a book before a rejected lending or return."""
+        if entry["id"] in self.cache and lending is not None:
+            book = self.cache[entry["id"]]
+            book.lent, lendingUser, lendingSince, book.lendingDays = lending
+            book.lendingUser = lendingUser
+            book.lendingSince = lendingSince
+            book.lendingState = None
+            self.applyQueued(book)
+
+        self.markConflict(entry["id"])
+
+    def markConflict(self, id):
+        """Marks a book whose lending or return was rejected and gets its actual state."""
+        if id in self.cache:
+            book = self.cache[id]
+            self.conflicts.add(id)
+            self.refreshBook(book)
+            self.fetch(book)
+
+    def enqueue(self, entry, first=False, callback=None):
+        """Queues a lending or return and applies it locally."""
+        if callback:
+            self.queueCallbacks[id(entry)] = callback
+
+        if first:
+            self.queue.insert(0, entry)
+        else:
+            self.queue.append(entry)
+
+        if self.journal is not None:
+            try:
+                if first:
+                    self.journal.rewrite(self.queue)
+                else:
+                    self.journal.append(entry)
+            except EnvironmentError:
+                pass
+
+        if entry["id"] in self.cache:
+            book = self.cache[entry["id"]]
+            self.applyEntry(book, entry)
+            self.refreshBook(book)
+
+        if not self.replayTicket:
+            self.replayTimer.start()
+
+    def applyEntry(self, book, entry):
+        if entry["action"] == "lend":
+            book.lent = True
+            if book.lendingUser != entry["user"]:
+                book.setLending(entry["user"], datetime.date.today().isoformat(), entry["days"])
+            else:
+                book.lendingDays = entry["days"]
+                book.lendingState = None
+        else:
+            book.lent = False
+            book.setLending()
+
+    def applyQueued(self, book):
+        """Applies the pending and queued entries of a book, that has been loaded from the server."""
+        for entry, lending in self.pending.values():
+            if entry["id"] == book.id:
+                self.applyEntry(book, entry)
+
+        for entry in self.queue:
+            if entry["id"] == book.id:
+                self.applyEntry(book, entry)
+
+    def applyQueue(self):
+        for entry in self.queue:
+            if entry["id"] in self.cache:
+                book = self.cache[entry["id"]]
+                self.applyEntry(book, entry)
+                self.refreshBook(book)
+
+    def replay(self):
+        """Sends the oldest queued lending or return."""
+        # A follow-up entry waits for the pending change of its book, that
+        # starts the replay when it is answered.
+        if self.queue and not self.replayTicket and not self.isPending(self.queue[0]["id"]):
+            self.replayTimer.stop()
+            self.replayEntry = self.queue[0]
+            self.replayTicket = self.sendLending(self.replayEntry, self.onReplayFinished)
+
+    def onReplayFinished(self, reply):
+        entry = self.replayEntry
+        self.replayTicket = None
+        self.replayEntry = None
+
+        # Still unreachable. Try again later.
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if status is None:
+            self.replayTimer.start()
+            return
+
+        # Entries may have been put in front of it in the meantime.
+        self.queue = [queued for queued in self.queue if queued is not entry]
+        try:
+            self.journal.rewrite(self.queue)
+        except EnvironmentError:
+            pass
+
+        callback = self.queueCallbacks.pop(id(entry), None)
+
+        if status in (200, 204):
+            self.onLendingReply(entry["id"], reply)
+        else:
+            # Changed (409), lent to someone else (412), already returned
+            # (404) or rejected.
+            self.markConflict(entry["id"])
+            if not callback:
+                self.replayFailed.emit(entry["id"], status)
+
+        # The entry was queued behind others while online. Report to the
+        # caller as if it had been sent right away.
+        if callback:
+            callback(reply)
+
+        self.replay()
+
+    def lendMany(self, books, user, days, callback=None):
+        """
+        Lends several books to one user with a single request. Books with
+        a pending or queued lending or return are queued behind it instead.
+        Gets None, if no request was sent.
+        """
+        queued = set(entry["id"] for entry in self.queue)
+        sent = []
+        for book in books:
+            if book.id in queued or self.isPending(book.id):
+                self.enqueue(self.lendingEntry(book, "lend", user, days))
+            else:
+                sent.append(book)
+
+        if not sent:
+            return None
+
+        body = json.dumps({"lendings": [
+            {"id": book.id, "etag": book.etag, "user": user, "days": days}
+            for book in sent
+        ]})
+
+        request = QNetworkRequest(self.app.login.getUrl("/lendings/"))
+        request.setHeader(QNetworkRequest.ContentTypeHeader, "application/json")
+        request.setRawHeader(QByteArray("X-CSRF-Token"), QByteArray(self.app.login.csrf))
+
+        def onFinished(reply):
+            results = self.onLendingsReply(reply)
+            if callback:
+                callback(reply, results)
+
+        return self.app.network.http("POST", request, QByteArray(body), onFinished)
+
+    def onBooksReply(self, reply):
+        """Handles a reply to a book list request."""
         request = reply.request()
         status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
-        method = request.attribute(network.HttpMethod)
-        path = request.url().path()
 
-        if path.endswith("/books/") and request.attribute(network.HttpMethod) == "POST":
-            # Book created.
-            data = json.loads(reply.readAll().data())
-            book = self.bookFromData(data)
+        # Book list not modified. The cache is still valid.
+        if status == 304:
+            return
 
-            assert not book.id in self.cache
+        # Book list downloaded. The decoder still has to catch up.
+        if self.streamTicket and request.attribute(network.Ticket) == self.streamTicket:
+            if status == 200:
+                self.onBooksReadyRead(reply)
 
-            self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
-            self.cache[book.id] = book
-            self.endInsertRows()
+                # The revision of the first page is the base for deltas.
+                if self.streamAfter is None and reply.hasRawHeader(QByteArray("X-Revision")):
+                    self.streamRevision = int(reply.rawHeader(QByteArray("X-Revision")).data())
 
-        # Book list updated.
-        if path.endswith("/books/") and request.attribute(network.HttpMethod) == "GET" and status == 200:
+                self.decodeFinished.emit(self.streamTicket)
+            else:
+                self.streamTicket = None
+            return
+
+        # Ignore full book lists that have been superseded by another one.
+        if status != 200 or not request.url().hasQueryItem("since"):
+            return
+
+        books = json.loads(reply.readAll().data())
+
+        if reply.hasRawHeader(QByteArray("X-Since")):
+            # Merge changes since the last known revision.
+            for key in books["books"]:
+                self.updateBook(book_from_data(books["books"][key]))
+
+            for id in books["deleted"]:
+                self.removeBook(int(id))
+        else:
             # Book list reloaded.
             self.beginResetModel()
             self.cache.clear()
+            self.searchIndex.clear()
 
-            blob = reply.readAll().data()
-            books = json.loads(blob)
-
-            for key in books:
-                book = self.bookFromData(books[key])
+            # Release the decoded data as soon as the book is built.
+            while books:
+                key, data = books.popitem()
+                book = book_from_data(data)
                 self.cache[book.id] = book
+                self.searchIndex.add(book)
 
             self.endResetModel()
 
-        # Book updated.
-        match = self.bookPathPattern.match(path)
-        if match:
-            id = int(match.group(1))
-
-            if method in ("GET", "PUT") and status == 200:
-                data = json.loads(reply.readAll().data())
-                book = self.bookFromData(data)
-                if book.id in self.cache:
-                    bookIndex = self.indexFromBook(self.cache[book.id])
-                    self.cache[book.id] = book
-                    self.dataChanged.emit(bookIndex, self.index(bookIndex.row(), self.columnCount() - 1, QModelIndex()))
-                else:
-                    self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
-                    self.cache[book.id] = book
-                    self.endInsertRows()
-            elif (method in ("GET", "PUT") and status == 404) or (method == "DELETE" and status in (200, 204)):
-                if id in self.cache:
-                    row = self.cache.keys().index(id)
-                    self.beginRemoveRows(QModelIndex(), row, row)
-                    del self.cache[id]
-                    self.endRemoveRows()
-
-        # Lending updated.
-        match = self.lendingPathPattern.match(path)
-        if match:
-            id = int(match.group(1))
-            if not id in self.cache:
-                return
+        if reply.hasRawHeader(QByteArray("X-Revision")):
+            self.revision = int(reply.rawHeader(QByteArray("X-Revision")).data())
 
-            book = self.cache[id]
+    def onBookCreated(self, reply):
+        """Handles a reply to a book creation request."""
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) != 200:
+            return
 
-            if method in ("POST", "PUT", "GET") and status == 200:
-                data = json.loads(reply.readAll().data())
-                book.lent = True
-                book.etag = int(reply.rawHeader(QByteArray("ETag")).data())
-                book.lendingUser = data["user"]
-                book.lendingSince = data["since"]
-                book.lendingDays = int(data["days"])
-            elif (method == "GET" and status == 404) or (method == "DELETE" and status in (200, 204)):
-                book.lent = False
-                book.etag = int(reply.rawHeader(QByteArray("ETag")).data())
-                book.lendingUser = None
-                book.lendingSince = None
-                book.lendingDays = None
-
-            bookIndex = self.indexFromBook(book)
-            self.dataChanged.emit(bookIndex, self.index(bookIndex.row(), self.columnCount() - 1, QModelIndex()))
+        # The event for the new book may have arrived first.
+        self.updateBook(book_from_data(json.loads(reply.readAll().data())))
 
-    def bookFromData(self, data):
-        book = Book()
+    def onBookReply(self, id, reply):
+        """Handles a reply to a request for a single book."""
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        method = reply.request().attribute(network.HttpMethod)
+
+        if method in ("GET", "PUT") and status == 200:
+            data = json.loads(reply.readAll().data())
+            self.updateBook(book_from_data(data))
+        elif (method in ("GET", "PUT") and status == 404) or (method == "DELETE" and status in (200, 204)):
+            self.removeBook(id)
+
+    def onLendingReply(self, id, reply):
+        """Handles a reply to a lending request."""
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        method = reply.request().attribute(network.HttpMethod)
+
+        if not id in self.cache:
+            return
+
+        book = self.cache[id]
+
+        if method in ("POST", "PUT", "GET") and status == 200:
+            data = json.loads(reply.readAll().data())
+            book.lent = True
+            book.etag = int(reply.rawHeader(QByteArray("ETag")).data())
+            book.setLending(data["user"], data["since"], int(data["days"]))
+        elif (method == "GET" and status == 404) or (method == "DELETE" and status in (200, 204)):
+            book.lent = False
+            book.etag = int(reply.rawHeader(QByteArray("ETag")).data())
+            book.setLending()
+        else:
+            return
+
+        self.conflicts.discard(id)
+        self.applyQueued(book)
+        self.refreshBook(book)
+
+    def onLendingsReply(self, reply):
+        """Applies the successful lendings of a bulk request and gets the results."""
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) != 200:
+            return None
+
+        results = json.loads(reply.readAll().data())
+
+        for result in results:
+            book = self.cache.get(result["id"])
+            if result["status"] != 200 or book is None:
+                continue
+
+            book.lent = True
+            book.etag = result["etag"]
+            book.setLending(result["lending"]["user"], result["lending"]["since"], int(result["lending"]["days"]))
+
+            self.conflicts.discard(book.id)
+            self.applyQueued(book)
+            self.refreshBook(book)
+
+        # Entries queued behind the lent books can be sent now.
+        self.replay()
+
+        return results
+
+    def refreshBook(self, book):
+        """Updates the search index and views after a book changed in place."""
+        self.searchIndex.add(book)
+        bookIndex = self.indexFromBook(book)
+        self.dataChanged.emit(bookIndex, self.index(bookIndex.row(), self.columnCount() - 1, QModelIndex()))
+
+    def updateBook(self, book):
+        """Inserts a new book or replaces the cached copy."""
+        self.applyQueued(book)
+
+        if book.id in self.cache:
+            bookIndex = self.indexFromBook(self.cache[book.id])
+            self.cache[book.id] = book
+            self.searchIndex.add(book)
+            self.dataChanged.emit(bookIndex, self.index(bookIndex.row(), self.columnCount() - 1, QModelIndex()))
+        else:
+            self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
+            self.cache[book.id] = book
+            self.searchIndex.add(book)
+            self.endInsertRows()
 
-        book.id = int(data["_id"])
-        book.etag = data["etag"]
-        book.isbn = data["isbn"]
-        book.title = data["title"]
-        book.authors = data["authors"]
-        book.volume = data["volume"]
-        book.edition = data["edition"]
-        book.topic = data["topic"]
-        book.keywords = data["keywords"]
-        book.signature = data["signature"]
-        book.location = data["location"]
-        book.year = int(data["year"]) if data["year"] else None
-        book.publisher = data["publisher"]
-        book.placeOfPublication = data["placeOfPublication"]
-        book.lendable = bool(data["lendable"])
-        book.lent = bool(data["lent"])
-
-        if book.lent and "lending" in data:
-            book.lendingUser = data["lending"]["user"]
-            book.lendingSince = data["lending"]["since"]
-            book.lendingDays = data["lending"]["days"]
-
-        return book
+    def removeBook(self, id):
+        """Removes a book from the cache, if present."""
+        if id in self.cache:
+            row = self.cache.keys().index(id)
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.cache[id]
+            self.searchIndex.remove(id)
+            self.conflicts.discard(id)
+            self.endRemoveRows()
 
     def indexFromBook(self, book):
-        books = self.cache.valuesview()
-        if book in books:
-            return self.createIndex(self.cache.keys().index(book.id), 0, book)
+        if self.cache.get(book.id) is book:
+            row = self.cache.keys().index(book.id)
+            return self.createIndex(row, 0, row)
         else:
             return QModelIndex()
 
@@ -374,7 +1096,7 @@ class BookTableModel(QAbstractTableModel):
         if not index.isValid():
             return None
         else:
-            return index.internalPointer()
+            return self.cache.bookAt(index.row())
 
     def getProxy(self):
         proxy = BookTableSortFilterProxyModel()
@@ -428,50 +1150,26 @@ class BookTableSortFilterProxyModel(QSortFilterProxyModel):
 
     def filterAcceptsRow(self, row, parent=QModelIndex()):
         """Checks if a book should be displayed."""
-        book = self.sourceModel().indexToBook(self.sourceModel().index(row, 0, parent))
+        # Stored books are only created for rows that need text fields.
+        cache = self.sourceModel().cache
 
-        if self.lentOnly and not book.lent:
+        if self.lentOnly and not cache.lentAt(row):
             return False
 
         if self.searchIsbn:
-            if self.searchIsbn == book.isbn:
+            if self.searchIsbn == cache.bookAt(row).isbn:
                 return True
             else:
                 return False
 
         if self.searchId:
-            if self.searchId == book.id:
+            if self.searchId == cache.idAt(row):
                 return True
             else:
                 return False
 
         if self.searchString:
-            if self.searchString in book.signature.lower():
-                return True
-            elif self.searchString in book.location.lower():
-                return True
-            elif self.searchString in book.title.lower():
-                return True
-            elif self.searchString in book.authors.lower():
-                return True
-            elif self.searchString in book.topic.lower():
-                return True
-            elif self.searchString in book.volume.lower():
-                return True
-            elif self.searchString in book.keywords.lower():
-                return True
-            elif self.searchString in book.publisher.lower():
-                return True
-            elif self.searchString in book.placeOfPublication.lower():
-                return True
-            elif self.searchString == str(book.year):
-                return True
-            elif self.searchString in book.edition.lower():
-                return True
-            elif book.lendingUser and self.searchString in book.lendingUser:
-                return True
-            else:
-                return False
+            return cache.idAt(row) in self.sourceModel().searchIndex.search(self.searchString)
 
         return True
 
@@ -493,7 +1191,7 @@ class LocationListModel(QAbstractListModel):
     def reload(self):
         self.beginResetModel()
 
-        items = set((book.location for book in self.app.books.cache.values()))
+        items = set(self.app.books.cache.column("location"))
 
         self.cache = list(items)
         self.cache.sort()
@@ -518,7 +1216,7 @@ class TopicListModel(QAbstractListModel):
     def reload(self):
         self.beginResetModel()
 
-        items = set((book.topic for book in self.app.books.cache.values()))
+        items = set(self.app.books.cache.column("topic"))
 
         self.cache = list(items)
         self.cache.sort()
@@ -570,8 +1268,7 @@ class BookDialog(QDialog):
         # Initialize form values.
         self.initValues()
 
-        # Handle network responses.
-        self.app.network.finished.connect(self.onNetworkRequestFinished)
+        # Saving in progress.
         self.ticket = None
 
     def initForm(self):
@@ -766,24 +1463,12 @@ class BookDialog(QDialog):
         params.addQueryItem("edition", self.editionBox.text())
         params.addQueryItem("lendable", "true" if self.lendableBox.isChecked() else "false")
 
-        if not self.book.id:
-            request = QNetworkRequest(self.app.login.getUrl("/books/"))
-            request.setHeader(QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded")
-            self.ticket = self.app.network.http("POST", request, params.encodedQuery())
-        else:
-            path = "/books/%d/" % self.book.id
-            request = QNetworkRequest(self.app.login.getUrl(path))
-            request.setHeader(QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded")
-            self.ticket = self.app.network.http("PUT", request, params.encodedQuery())
+        self.ticket = self.app.books.save(self.book, params, self.onSaveFinished)
 
         return True
 
-    def onNetworkRequestFinished(self, reply):
-        """Handles responses."""
-        # Only handle requests that concern this dialog.
-        if self.ticket != reply.request().attribute(network.Ticket):
-            return
-
+    def onSaveFinished(self, reply):
+        """Handles the response to saving."""
         self.ticket = None
         self.showBusy(False)
 
@@ -878,46 +1563,48 @@ class LendingDialog(QDialog):
         self.setWindowIcon(QIcon(self.app.data("basket.png")))
         self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
 
-        # Create the stack of the different views and a busy indicator.
+        # Create the stack of the different views. Lendings and returns are
+        # shown right away, so there is no busy indicator.
         self.layoutStack = QStackedLayout(self)
         self.layoutStack.addWidget(self.initLendPage())
         self.layoutStack.addWidget(self.initReturnPage())
-        self.layoutStack.addWidget(self.initBusyIndicator())
 
         # Initialize the displayed values.
-        self.updateValues(False)
-
-        # Handle network responses.
-        self.app.network.finished.connect(self.onNetworkRequestFinished)
-        self.ticket = None
+        self.updateValues()
 
-        # Handle book data changes.
+        # Handle book data changes, until the dialog is closed.
         self.app.books.dataChanged.connect(self.onBooksDataChanged)
         self.app.books.modelReset.connect(self.onBooksModelReset)
+        self.app.books.rowsRemoved.connect(self.onBooksRowsRemoved)
+        self.attached = True
+
+    def detach(self):
+        """Stops following changes of the book model."""
+        if self.attached:
+            self.attached = False
+            self.app.books.dataChanged.disconnect(self.onBooksDataChanged)
+            self.app.books.modelReset.disconnect(self.onBooksModelReset)
+            self.app.books.rowsRemoved.disconnect(self.onBooksRowsRemoved)
 
     def onBooksDataChanged(self, topLeft, bottomRight):
-        for row in range(topLeft.row(), bottomRight.row() + 1):
-            if self.book.id == self.app.books.index(row, 0, QModelIndex()).data(Qt.UserRole):
-                self.updateValues(False)
-                break
+        if self.book.id in self.app.books.cache:
+            row = self.app.books.cache.keys().index(self.book.id)
+            if topLeft.row() <= row <= bottomRight.row():
+                self.updateValues()
 
     def onBooksModelReset(self):
-        self.updateValues(False)
+        self.updateValues()
+
+    def onBooksRowsRemoved(self, parent, first, last):
+        self.updateValues()
 
-    def updateValues(self, busy):
+    def updateValues(self):
         if not self.book.id in self.app.books.cache:
             self.reject()
             return
 
         self.book = self.app.books.cache[self.book.id]
 
-        if busy:
-            self.layoutStack.setCurrentIndex(2)
-            self.busyIndicator.setEnabled(True)
-            return
-        else:
-            self.busyIndicator.setEnabled(False)
-
         if not self.book.lent:
             self.setWindowTitle("Buch ausleihen: %s" % self.book.title)
             self.layoutStack.setCurrentIndex(0)
@@ -938,9 +1625,7 @@ class LendingDialog(QDialog):
             self.returnLocationBox.setText(self.book.location)
             self.returnSignatureBox.setText(self.book.signature)
 
-            today = datetime.date.today()
-            since = dateutil.parser.parse(self.book.lendingSince).date()
-            duration = (today - since).days
+            duration, overdue = self.book.lendingStatus()
             if duration == 0:
                 self.returnLendingBox.setText("<a href=\"mailto:%s\">%s</a> seit heute" % (self.book.lendingUser, self.book.lendingUser))
             elif duration == 1:
@@ -950,7 +1635,7 @@ class LendingDialog(QDialog):
 
             palette = self.returnLendingBox.palette()
             role = self.returnLendingBox.backgroundRole()
-            if duration > self.book.lendingDays:
+            if overdue:
                 palette.setColor(role, QColor(231, 76, 60))
             else:
                 palette.setColor(role, QColor(46, 204, 113))
@@ -983,11 +1668,7 @@ class LendingDialog(QDialog):
         self.lendLendableBox = QLabel()
         form.addRow("Ausleihbar:", self.lendLendableBox)
 
-        self.lendUserBox = QComboBox()
-        self.lendUserBox.setModel(self.app.users)
-        self.lendUserBox.setEditable(True)
-        self.lendUserBox.setInsertPolicy(QComboBox.NoInsert)
-        self.lendUserBox.setCurrentIndex(-1)
+        self.lendUserBox = user.UserComboBox(self.app)
         form.addRow("Ausleihen an:", self.lendUserBox)
 
         row = QHBoxLayout()
@@ -1046,10 +1727,6 @@ class LendingDialog(QDialog):
         widget.setLayout(form)
         return widget
 
-    def initBusyIndicator(self):
-        self.busyIndicator = busyindicator.BusyIndicator()
-        return self.busyIndicator
-
     def onLongLendButton(self):
         self.doLend(28)
 
@@ -1058,47 +1735,122 @@ class LendingDialog(QDialog):
 
     def doLend(self, days):
         user = self.lendUserBox.currentText()
-
-        params = QUrl()
-        params.addQueryItem("_csrf", self.app.login.csrf)
-        params.addQueryItem("user", user)
-        params.addQueryItem("days", str(days))
-        params.addQueryItem("etag", str(self.book.etag))
-
-        path = "/books/%d/lending" % self.book.id
-        request = QNetworkRequest(self.app.login.getUrl(path))
-        request.setHeader(QNetworkRequest.ContentTypeHeader, "application/x-www-form-urlencoded")
-        self.ticket = self.app.network.http("POST", request, params.encodedQuery())
-        self.updateValues(True)
+        self.app.books.lend(self.book, user, days, self.onLendingFinished)
 
     def onReturnButton(self):
-        path = "/books/%d/lending" % self.book.id
-        request = QNetworkRequest(self.app.login.getUrl(path))
-        request.setRawHeader(QByteArray("X-CSRF-Token"), QByteArray(self.app.login.csrf))
-        self.ticket = self.app.network.http("DELETE", request)
-        self.updateValues(True)
+        self.app.books.returnBook(self.book, self.onLendingFinished)
 
-    def closeEvent(self, event):
-        # Saving in progress.
-        if self.ticket:
-            event.ignore()
-            return
+    def done(self, result):
+        self.detach()
+        super(LendingDialog, self).done(result)
 
+    def closeEvent(self, event):
         # Maintain list of open dialogs.
         if self.book.id in LendingDialog.dialogs:
             del LendingDialog.dialogs[self.book.id]
 
+        self.detach()
         event.accept()
 
-    def onNetworkRequestFinished(self, reply):
-        # Only handle requests concerning this dialog.
-        request = reply.request()
-        if request.attribute(network.Ticket) != self.ticket:
+    def onLendingFinished(self, reply):
+        # The server is unreachable. The lending has been queued.
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) is None:
             return
 
-        # Update the user interface.
+        # Check for network errors.
+        if reply.error() != QNetworkReply.NoError:
+            QMessageBox.warning(self, self.windowTitle(), self.app.login.censorError(reply.errorString()))
+            return
+
+        # Check for HTTP errors.
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if not status in (200, 204):
+            QMessageBox.warning(self, self.windowTitle(), "HTTP Status Code: %d" % status)
+            return
+
+
+class BulkLendingDialog(QDialog):
+    """A dialog for lending several books to one user at once."""
+
+    REASONS = {
+        400: u"ungültige Ausleihe",
+        404: u"Buch nicht gefunden",
+        409: u"Buch wurde inzwischen geändert",
+        412: u"bereits an jemand anderen ausgeliehen",
+    }
+
+    def __init__(self, app, books, parent):
+        super(BulkLendingDialog, self).__init__(parent)
+        self.app = app
+        self.books = books
+
+        self.setWindowTitle(u"Sammelausleihe: %d Bücher" % len(books))
+        self.setWindowIcon(QIcon(self.app.data("basket.png")))
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
+
+        self.layoutStack = QStackedLayout(self)
+        self.layoutStack.addWidget(self.initForm())
+        self.layoutStack.addWidget(self.initBusyIndicator())
+
+        # Lending in progress.
         self.ticket = None
-        self.updateValues(False)
+
+    def initForm(self):
+        form = QFormLayout()
+
+        self.booksBox = QListWidget()
+        for book in self.books:
+            self.booksBox.addItem("%d: %s" % (book.id, book.title))
+        form.addRow(u"Bücher:", self.booksBox)
+
+        self.userBox = user.UserComboBox(self.app)
+        form.addRow("Ausleihen an:", self.userBox)
+
+        row = QHBoxLayout()
+        row.addStretch(1)
+        self.longLendButton = QPushButton(u"Für 4 Wochen ausleihen")
+        self.longLendButton.setIcon(QIcon(self.app.data("basket-go.png")))
+        self.longLendButton.clicked.connect(self.onLongLendButton)
+        row.addWidget(self.longLendButton)
+        self.shortLendButton = QPushButton(u"Für 7 Tage ausleihen")
+        self.shortLendButton.setIcon(QIcon(self.app.data("basket-go.png")))
+        self.shortLendButton.clicked.connect(self.onShortLendButton)
+        row.addWidget(self.shortLendButton)
+        form.addRow(row)
+
+        widget = QWidget()
+        widget.setLayout(form)
+        return widget
+
+    def initBusyIndicator(self):
+        self.busyIndicator = busyindicator.BusyIndicator()
+        return self.busyIndicator
+
+    def showBusy(self, visible):
+        self.busyIndicator.setEnabled(visible)
+        self.layoutStack.setCurrentIndex(1 if visible else 0)
+
+    def onLongLendButton(self):
+        self.doLend(28)
+
+    def onShortLendButton(self):
+        self.doLend(7)
+
+    def doLend(self, days):
+        user = self.userBox.currentText()
+        if not user:
+            QMessageBox.warning(self, self.windowTitle(), u"Bitte einen Benutzer auswählen.")
+            return
+
+        self.ticket = self.app.books.lendMany(self.books, user, days, self.onLendingFinished)
+        if self.ticket:
+            self.showBusy(True)
+        else:
+            self.accept()
+
+    def onLendingFinished(self, reply, results):
+        self.ticket = None
+        self.showBusy(False)
 
         # Check for network errors.
         if reply.error() != QNetworkReply.NoError:
@@ -1107,10 +1859,29 @@ class LendingDialog(QDialog):
 
         # Check for HTTP errors.
         status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
-        if not status in (200, 204):
+        if status != 200:
             QMessageBox.warning(self, self.windowTitle(), "HTTP Status Code: %d" % status)
             return
 
+        # Report the books that could not be lent.
+        failures = [
+            u"%s: %s" % (result["id"], self.REASONS.get(result["status"], "HTTP Status Code: %d" % result["status"]))
+            for result in results if result["status"] != 200
+        ]
+        if failures:
+            QMessageBox.warning(self, self.windowTitle(),
+                u"%d von %d Büchern konnten nicht ausgeliehen werden:\n\n%s" % (len(failures), len(results), "\n".join(failures)))
+
+        self.accept()
+
+    def closeEvent(self, event):
+        # Lending in progress.
+        if self.ticket:
+            event.ignore()
+            return
+
+        event.accept()
+
 
 class LabelPrintDialog(QDialog):
     """Allows printing labels for the selected books."""
@@ -1231,3 +2002,49 @@ class SearchDialog(QDialog):
         """Make dialog a bit wider than nescessary."""
         size = super(SearchDialog, self).sizeHint()
         return QSize(size.width() + 150, size.height())
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: data() calls per second for the roles that views ask
+    # for while painting and sorting.
+    import sys
+    import timeit
+
+    app = QApplication(sys.argv)
+
+    class BenchmarkModel(BookTableModel):
+        def __init__(self, books):
+            QAbstractTableModel.__init__(self)
+            self.cache = BookCache((book.id, book) for book in books)
+            self.conflicts = set()
+            self.titleFont = QFont()
+            self.titleFont.setBold(True)
+            self.overdueColor = QColor(231, 76, 60)
+            self.lentColor = QColor(46, 204, 113)
+            self.notLendableColor = QColor(236, 240, 241)
+            self.conflictColor = QColor(243, 156, 18)
+
+    books = []
+    for id in range(50000):
+        book = Book()
+        book.id = id
+        book.title = u"Titel %d" % id
+        book.authors = u"Autor %d" % (id % 100)
+        book.lendable = id % 5 != 0
+        if id % 3 == 0:
+            book.lent = True
+            book.setLending(u"user%d" % (id % 7), "2015-01-%02d" % (id % 28 + 1), 14)
+        books.append(book)
+
+    model = BenchmarkModel(books)
+    indexes = [model.index(row, column) for row in range(len(books)) for column in (0, 4, 15)]
+    roles = [Qt.UserRole, Qt.DisplayRole, Qt.BackgroundRole, Qt.TextAlignmentRole, Qt.FontRole]
+
+    def paint():
+        for index in indexes:
+            for role in roles:
+                model.data(index, role)
+
+    calls = len(indexes) * len(roles)
+    seconds = min(timeit.repeat(paint, number=1, repeat=3))
+    print("%d data() calls: %.0f calls/s" % (calls, calls / seconds))
@@ -17,6 +17,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import bisect
 import collections
 import operator
 import sys
@@ -57,8 +58,18 @@ except ImportError:
         return decorating_function
 
 
+_tombstone = object()
+
+
 class IndexedOrderedDict(dict):
-    """A dictionary that is indexed by insertion order."""
+    """
+    A dictionary that is indexed by insertion order.
+
+    Positions are kept in a key to position map. Deleted keys leave a
+    tombstone in the ordered key list. Positions are corrected by the
+    sorted list of tombstones, until there are enough of them to justify
+    compacting the key list.
+    """
 
     def __init__(self, *args, **kwds):
         """
@@ -70,30 +81,113 @@ class IndexedOrderedDict(dict):
             raise TypeError('expected at most 1 arguments, got %d' % len(args))
 
         self._map = []
+        self._index = {}
+        self._holes = []
         self.__update(*args, **kwds)
 
     def __setitem__(self, key, value, dict_setitem=dict.__setitem__):
         """iod.__setitem__(i, y) <==> iod[i] = y"""
         if key not in self:
+            self._index[key] = len(self._map)
             self._map.append(key)
         dict_setitem(self, key, value)
 
     def __delitem__(self, key, dict_delitem=dict.__delitem__):
         """iod.__delitem__(y) <==> del iod[y]"""
         dict_delitem(self, key)
-        self._map.remove(key)
+        position = self._index.pop(key)
+
+        if position == len(self._map) - 1:
+            # Deleting the last key does not require a tombstone.
+            self._map.pop()
+            while self._holes and self._holes[-1] == len(self._map) - 1:
+                self._holes.pop()
+                self._map.pop()
+        else:
+            self._map[position] = _tombstone
+            bisect.insort(self._holes, position)
+            if len(self._holes) * 4 > len(self._map):
+                self._compact()
+
+    def extend(self, keys, values):
+        """
+        Appends keys with their values. Much faster than setting them one
+        by one, if the keys are unique and not yet present.
+        """
+        keys = list(keys)
+        values = list(values)
+
+        start = len(self._map)
+        index = dict(zip(keys, range(start, start + len(keys))))
+        if len(index) != len(keys) or (self and any(key in self for key in keys)):
+            for key, value in zip(keys, values):
+                self[key] = value
+            return
+
+        self._index.update(index)
+        self._map.extend(keys)
+        dict.update(self, zip(keys, values))
+
+    def _compact(self):
+        """Removes all tombstones and renumbers the positions."""
+        if not self._holes:
+            return
+
+        start = self._holes[0]
+        keys = [key for key in self._map[start:] if key is not _tombstone]
+        del self._map[start:]
+
+        for position, key in enumerate(keys, start):
+            self._index[key] = position
+        self._map.extend(keys)
+
+        del self._holes[:]
+
+    def _keyAt(self, index):
+        """Gets the key at the given position."""
+        holes = self._holes
+        if not holes or (isinstance(index, int) and 0 <= index < holes[0]):
+            return self._map[index]
+        elif not isinstance(index, int) or index < 0:
+            self._compact()
+            return self._map[index]
+        elif index >= len(self):
+            raise IndexError('index out of range')
+
+        # Find the first position that has index keys in front of it.
+        low, high = index, index + len(holes)
+        while low < high:
+            middle = (low + high) // 2
+            if middle + 1 - bisect.bisect_right(holes, middle) <= index:
+                low = middle + 1
+            else:
+                high = middle
+        return self._map[low]
+
+    def _position(self, key):
+        """Gets the position of the given key."""
+        position = self._index[key]
+        if self._holes:
+            position -= bisect.bisect_left(self._holes, position)
+        return position
 
     def __iter__(self):
         """iod.__iter__() <==> iter(iod)"""
-        return self._map.__iter__()
+        if not self._holes:
+            return self._map.__iter__()
+        return (key for key in self._map if key is not _tombstone)
 
     def __reversed__(self):
         """iod.__reversed__() <==> reversed(iod)"""
-        return self._map.__reversed__()
+        if not self._holes:
+            return self._map.__reversed__()
+        return (key for key in reversed(self._map) if key is not _tombstone)
 
     def clear(self):
         """iod.clear() -> None.  Remove all items from iod."""
         self._map[:] = []
+        self._index.clear()
+        del self._holes[:]
         dict.clear(self)
 
     def popitem(self, last=True):
@@ -101,8 +195,10 @@ class IndexedOrderedDict(dict):
         iod.popitem() -> (k, v), return and remove a (key, value) pair.
         Pairs are returned LIFO order if last is true or FIFI order if false.
         """
-        key = self._map.pop() if last else self._map.pop(0)
-        value = dict.pop(self, key)
+        if not self:
+            raise KeyError('dictionary is empty')
+        key = self._keyAt(-1 if last else 0)
+        value = self.pop(key)
         return key, value
 
     def move_to_end(self, key, last=True):
@@ -112,14 +208,20 @@ class IndexedOrderedDict(dict):
         Raises KeyError if the element does not exist.
         When last=True, acts like a faster version of self[key]=self.pop(key).
         """
-        self._map.remove(key)
+        value = dict.__getitem__(self, key)
         if last:
-            self._map.append(key)
+            del self[key]
+            self[key] = value
         else:
+            self._compact()
+            self._map.remove(key)
             self._map.insert(0, key)
+            for position, other in enumerate(self._map):
+                self._index[other] = position
 
     def __sizeof__(self):
-        return sys.getsizeof(self.__dict__) + sys.getsizeof(self._map)
+        return (sys.getsizeof(self.__dict__) + sys.getsizeof(self._map) +
+                sys.getsizeof(self._index) + sys.getsizeof(self._holes))
 
     update = __update = collections.MutableMapping.update
     __ne__ = collections.MutableMapping.__ne__
@@ -207,21 +309,58 @@ class IndexedOrderedDict(dict):
 class IndexedKeysView(collections.KeysView):
 
     def __getitem__(self, index):
-        return self._mapping._map[index]
+        return self._mapping._keyAt(index)
 
     def index(self, x):
-        return self._mapping._map.index(x)
+        return self._mapping._position(x)
 
 
 class IndexedValuesView(collections.ValuesView):
 
     def __getitem__(self, index):
-        key = self._mapping._map[index]
+        key = self._mapping._keyAt(index)
         return self._mapping[key]
 
 
 class IndexedItemsView(collections.ItemsView):
 
     def __getitem__(self, index):
-        key = self._mapping._map[index]
+        key = self._mapping._keyAt(index)
         return key, self._mapping[key]
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: The time per operation should not grow with the size.
+    import timeit
+
+    def benchmark(size):
+        iod = IndexedOrderedDict((key, key) for key in range(size))
+        keys = list(range(size))
+        values = iod.values()
+        positions = iod.keys()
+
+        def access():
+            for row in range(0, size, 7):
+                values[row]
+
+        def index():
+            for key in range(0, size, 7):
+                positions.index(key)
+
+        def delete():
+            # Delete from the back half, then look up rows in front of it,
+            # like BookTableModel.removeBook followed by repaints.
+            for key in keys[size // 2::7]:
+                positions.index(key)
+                del iod[key]
+                values[size // 4]
+            for key in keys[size // 2::7]:
+                iod[key] = key
+
+        operations = len(range(0, size, 7))
+        for name, function in (("access", access), ("index", index), ("delete", delete)):
+            seconds = min(timeit.repeat(function, number=1, repeat=3))
+            print("%8d %-8s %8.3f us/op" % (size, name, seconds / operations * 1e6))
+
+    for size in (1000, 10000, 100000):
+        benchmark(size)
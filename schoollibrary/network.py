@@ -20,37 +20,430 @@
 from PySide.QtCore import *
 from PySide.QtNetwork import *
 
+import base64
+import bisect
+import collections
+import heapq
+import itertools
+import os
+import time
 import uuid
 
 
 Ticket = QNetworkRequest.Attribute(QNetworkRequest.User)
 HttpMethod = QNetworkRequest.Attribute(QNetworkRequest.User + 1)
 
+# Request priorities. Lower values are sent first. Streams stay open and
+# do not count against the limit of concurrent requests per host.
+Interactive = 0
+Background = 1
+Stream = 2
+
+# Upper bounds of the latency histogram in seconds. The last bucket is
+# everything slower.
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+
+class Session(object):
+    """
+    The server and credentials of a login. The Authorization header is
+    computed once and sent with every request.
+    """
+
+    def __init__(self, url, userName, password):
+        # The user name stays in the URL, so that cached responses of
+        # different users are kept apart.
+        self.baseUrl = QUrl(QUrl(url).toString(QUrl.RemovePassword))
+        self.baseUrl.setUserName(userName)
+
+        self.basePath = self.baseUrl.path()
+        if self.basePath.endswith("/"):
+            self.basePath = self.basePath[:-1]
+
+        credentials = (u"%s:%s" % (userName, password)).encode("utf-8")
+        self.authorization = QByteArray("Basic " + base64.b64encode(credentials))
+
+    def url(self, path=None):
+        """Gets the URL of a path on the server."""
+        url = QUrl(self.baseUrl)
+        if path:
+            url.setPath(self.basePath + path)
+        return url
+
 
 class NetworkService(QNetworkAccessManager):
+    """
+    Sends requests by priority, with a limited number of concurrent
+    requests per host. Identical GET requests in flight share a ticket.
+    """
 
-    def __init__(self, app, parent=None):
+    def __init__(self, app, parent=None, maxPerHost=4):
         super(NetworkService, self).__init__(parent)
         self.app = app
+        self.maxPerHost = maxPerHost
 
-    def http(self, method, request, arg=None):
-        ticket = str(uuid.uuid4())
-        request.setAttribute(Ticket, ticket)
+        # Replies that are still in progress and their consumers by ticket.
+        self.replies = {}
+        self.callbacks = {}
+        self.finished.connect(self.onFinished)
+
+        # Requests waiting to be sent, as a heap of priority, order and
+        # ticket. Entries whose priority has changed are skipped.
+        self.queue = []
+        self.queued = {}
+        self.sequence = itertools.count()
 
+        # Running requests per host.
+        self.running = collections.defaultdict(int)
+        self.hosts = {}
+
+        # Tickets of GET requests in flight by URL and headers.
+        self.coalesced = {}
+        self.keys = {}
+
+        # Set by the login.
+        self.session = None
+
+        # Counters of requests, body bytes, pipelined and cached replies,
+        # and the latencies of requests other than streams.
+        self.stats = collections.Counter()
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.started = {}
+        self.received = {}
+
+    def http(self, method, request, arg=None, callback=None, readyRead=None, priority=None):
+        """
+        Sends a request and gets its ticket. The callback gets the reply,
+        readyRead gets it whenever data arrives.
+
+        Writes are interactive and reads are background requests, unless
+        a priority is given.
+        """
         method = method.upper()
+        if priority is None:
+            priority = Background if method in ("GET", "HEAD") else Interactive
+
+        if self.session is not None:
+            request.setRawHeader(QByteArray("Authorization"), self.session.authorization)
+
+        # Share a reply with an identical GET request. Streamed replies can
+        # only be read once.
+        key = None
+        if method == "GET" and readyRead is None:
+            key = self.requestKey(request)
+            if key in self.coalesced:
+                ticket = self.coalesced[key]
+                if callback:
+                    self.callbacks.setdefault(ticket, []).append(callback)
+                if ticket in self.queued and priority < self.queued[ticket][4]:
+                    self.enqueue(ticket, self.queued[ticket][:4] + (priority, ))
+                return ticket
+
+        ticket = str(uuid.uuid4())
+        request.setAttribute(Ticket, ticket)
         request.setAttribute(HttpMethod, method)
 
+        # Reads may share connections with other reads. Streamed replies
+        # can take long or never end, so nothing may wait behind them.
+        if method in ("GET", "HEAD") and readyRead is None and priority != Stream:
+            request.setAttribute(QNetworkRequest.HttpPipeliningAllowedAttribute, True)
+
+        if callback:
+            self.callbacks[ticket] = [callback]
+        if key is not None:
+            self.coalesced[key] = ticket
+            self.keys[ticket] = key
+
+        self.enqueue(ticket, (method, request, arg, readyRead, priority))
+        self.schedule()
+        return ticket
+
+    def requestKey(self, request):
+        headers = tuple((name.data(), request.rawHeader(name).data()) for name in request.rawHeaderList())
+        return request.url().toEncoded().data(), headers
+
+    def host(self, request):
+        return request.url().host(), request.url().port()
+
+    def enqueue(self, ticket, queued):
+        self.queued[ticket] = queued
+        heapq.heappush(self.queue, (queued[4], next(self.sequence), ticket))
+
+    def schedule(self):
+        """Sends queued requests, while their hosts have free connections."""
+        waiting = []
+
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            priority, sequence, ticket = entry
+            if ticket not in self.queued or self.queued[ticket][4] != priority:
+                continue
+
+            host = self.host(self.queued[ticket][1])
+            if priority != Stream and self.running[host] >= self.maxPerHost:
+                waiting.append(entry)
+            else:
+                self.send(ticket)
+
+        for entry in waiting:
+            heapq.heappush(self.queue, entry)
+
+    def send(self, ticket):
+        method, request, arg, readyRead, priority = self.queued.pop(ticket)
+
+        if priority != Stream:
+            host = self.hosts[ticket] = self.host(request)
+            self.running[host] += 1
+            self.started[ticket] = time.time()
+
+        self.stats["requests"] += 1
+        if arg is not None:
+            self.stats["bytesSent"] += len(arg)
+
         if method == "DELETE":
-            self.deleteResource(request)
+            reply = self.deleteResource(request)
         elif method == "GET":
-            self.get(request)
+            reply = self.get(request)
         elif method == "HEAD":
-            self.head(request)
+            reply = self.head(request)
         elif method == "POST":
-            self.post(request, arg)
+            reply = self.post(request, arg)
         elif method == "PUT":
-            self.put(request, arg)
+            reply = self.put(request, arg)
         else:
-            self.sendCustomRequest(request, method, arg)
+            reply = self.sendCustomRequest(request, method, arg)
 
-        return ticket
+        self.replies[ticket] = reply
+        reply.downloadProgress.connect(lambda received, total: self.received.__setitem__(ticket, received))
+        if readyRead:
+            reply.readyRead.connect(lambda: readyRead(reply))
+
+    def subscribe(self, path):
+        """Creates a subscription to server-sent events at the given path."""
+        return EventStream(self, path)
+
+    def release(self, ticket):
+        """Drops the callbacks of a request that is no longer of interest."""
+        self.callbacks.pop(ticket, None)
+
+    def abort(self, ticket):
+        """Drops the callbacks of a request and cancels it."""
+        self.release(ticket)
+
+        if ticket in self.queued:
+            del self.queued[ticket]
+            self.coalesced.pop(self.keys.pop(ticket, None), None)
+        elif ticket in self.replies:
+            self.replies[ticket].abort()
+
+    def onFinished(self, reply):
+        ticket = reply.request().attribute(Ticket)
+        self.replies.pop(ticket, None)
+        self.coalesced.pop(self.keys.pop(ticket, None), None)
+
+        self.stats["bytesReceived"] += self.received.pop(ticket, 0)
+        if reply.attribute(QNetworkRequest.HttpPipeliningWasUsedAttribute):
+            self.stats["pipelined"] += 1
+        if reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute):
+            self.stats["fromCache"] += 1
+        if ticket in self.started:
+            latency = time.time() - self.started.pop(ticket)
+            self.latencies[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+        host = self.hosts.pop(ticket, None)
+        if host is not None:
+            self.running[host] -= 1
+            self.schedule()
+
+        # Each consumer of a shared reply reads the body on its own.
+        callbacks = self.callbacks.pop(ticket, [])
+        if len(callbacks) > 1:
+            data = reply.readAll()
+            for callback in callbacks:
+                callback(BufferedReply(reply, data))
+        elif callbacks:
+            callbacks[0](reply)
+
+
+class BufferedReply(object):
+    """A finished reply, whose body can be read again."""
+
+    def __init__(self, reply, data):
+        self.reply = reply
+        self.buffer = QBuffer()
+        self.buffer.setData(data)
+        self.buffer.open(QIODevice.ReadOnly)
+
+    def __getattr__(self, name):
+        if name in ("read", "readAll", "readLine", "canReadLine", "atEnd", "bytesAvailable", "peek"):
+            return getattr(self.buffer, name)
+        else:
+            return getattr(self.reply, name)
+
+
+def uncached(request):
+    """Makes a request bypass the response cache, for streams and large lists."""
+    request.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.AlwaysNetwork)
+    request.setAttribute(QNetworkRequest.CacheSaveControlAttribute, False)
+    return request
+
+
+class ResponseCache(QNetworkDiskCache):
+    """
+    Keeps responses with their ETags on disk, so that they can be
+    revalidated with If-None-Match. When the cache is full, the least
+    recently used responses are removed.
+    """
+
+    def __init__(self, directory, maximumSize=50 * 1024 * 1024, parent=None):
+        super(ResponseCache, self).__init__(parent)
+        self.setCacheDirectory(directory)
+        self.setMaximumCacheSize(maximumSize)
+
+        # Access times of this session by URL. They are written to the
+        # modification times of the files when the cache is expired.
+        self.accessed = {}
+
+    def metaData(self, url):
+        # Looked up for every request, to get the validators.
+        self.accessed[url.toString(QUrl.RemovePassword)] = time.time()
+        return super(ResponseCache, self).metaData(url)
+
+    def expire(self):
+        """Removes the least recently used responses, down to 90% of the maximum size."""
+        files = []
+        size = 0
+        for root, directories, names in os.walk(self.cacheDirectory()):
+            for name in names:
+                if name.endswith(".d"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((path, stat.st_size, stat.st_mtime))
+                    size += stat.st_size
+
+        if size <= self.maximumCacheSize():
+            return size
+
+        entries = []
+        for path, fileSize, modified in files:
+            url = self.fileMetaData(path).url().toString(QUrl.RemovePassword)
+            accessed = self.accessed.get(url, modified)
+            if accessed != modified:
+                os.utime(path, (accessed, accessed))
+            entries.append((accessed, fileSize, path))
+
+        goal = self.maximumCacheSize() * 9 // 10
+        for accessed, fileSize, path in sorted(entries):
+            if size <= goal:
+                break
+            try:
+                os.remove(path)
+                size -= fileSize
+            except EnvironmentError:
+                pass
+
+        return size
+
+
+def chain(*callbacks):
+    """Combines reply callbacks, skipping those that are None."""
+    callbacks = [callback for callback in callbacks if callback]
+
+    def onFinished(reply):
+        for callback in callbacks:
+            callback(reply)
+
+    return onFinished
+
+
+class EventStream(QObject):
+    """
+    Receives server-sent events. The stream is reopened after it ends,
+    waiting as long as the server asked for.
+    """
+
+    received = Signal(str, str)
+    connected = Signal()
+
+    def __init__(self, network, path):
+        super(EventStream, self).__init__(network)
+        self.network = network
+        self.path = path
+        self.active = False
+        self.ticket = None
+        self.retry = 5000
+
+        self.reconnectTimer = QTimer(self)
+        self.reconnectTimer.setSingleShot(True)
+        self.reconnectTimer.timeout.connect(self.open)
+
+    def start(self):
+        self.active = True
+        if not self.ticket:
+            self.open()
+
+    def stop(self):
+        self.active = False
+        self.reconnectTimer.stop()
+
+        if self.ticket:
+            self.network.abort(self.ticket)
+            self.ticket = None
+
+    def open(self):
+        self.opened = False
+        self.buffer = ""
+        self.event = ""
+        self.data = []
+
+        request = uncached(QNetworkRequest(self.network.app.login.getUrl(self.path)))
+        request.setRawHeader(QByteArray("Accept"), QByteArray("text/event-stream"))
+        self.ticket = self.network.http("GET", request, callback=self.onFinished,
+                                        readyRead=self.onReadyRead, priority=Stream)
+
+    def onReadyRead(self, reply):
+        if reply.request().attribute(Ticket) != self.ticket:
+            return
+
+        if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute) != 200:
+            return
+
+        if not self.opened:
+            self.opened = True
+            self.connected.emit()
+
+        lines = (self.buffer + reply.readAll().data()).split("\n")
+        self.buffer = lines.pop()
+
+        # Lines are split before decoding, because a newline never occurs
+        # within a UTF-8 encoded character.
+        for line in lines:
+            line = line.rstrip("\r").decode("utf-8", "replace")
+
+            # An empty line dispatches the event.
+            if not line:
+                if self.data:
+                    self.received.emit(self.event or "message", "\n".join(self.data))
+                self.event = ""
+                self.data = []
+                continue
+
+            # Comments keep the connection alive.
+            if line.startswith(":"):
+                continue
+
+            field, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+
+            if field == "event":
+                self.event = value
+            elif field == "data":
+                self.data.append(value)
+            elif field == "retry" and value.isdigit():
+                self.retry = int(value)
+
+    def onFinished(self, reply):
+        self.ticket = None
+        if self.active:
+            self.reconnectTimer.start(self.retry)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# Client for a schoollibrary-server.
+# Copyright (c) 2014-2015 Niklas Fiekas <niklas@backscattering.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have receicved a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import collections
+import re
+
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+# Searchable fields, in the order of the haystack.
+HAYSTACK_FIELDS = [
+    "signature", "location", "title", "authors", "topic", "volume",
+    "keywords", "publisher", "placeOfPublication", "edition",
+]
+
+
+def haystack(book):
+    """Gets the lowercased searchable text of a book."""
+    return join_haystack([
+        book.signature, book.location, book.title, book.authors,
+        book.topic, book.volume, book.keywords, book.publisher,
+        book.placeOfPublication, book.edition,
+    ], book.lendingUser)
+
+
+def join_haystack(fields, user):
+    """Gets the haystack of the values of HAYSTACK_FIELDS and the lending user."""
+    # The lending user is matched case sensitively.
+    return u"\n".join(fields).lower() + u"\n" + (user or u"")
+
+
+class SearchIndex(object):
+    """
+    Searches the lowercased text of books.
+
+    The haystacks are maintained as books are added and removed. An
+    inverted word index of sets of ids is built on the first search in a
+    large catalogue and then maintained incrementally. Results of recent
+    searches are kept up to date, so filtering a proxy model only has to
+    look up ids.
+
+    Books can be deferred, so that their haystacks are only loaded on the
+    first search.
+    """
+
+    def __init__(self, minIndexed=10000, maxResults=16):
+        self.minIndexed = minIndexed
+        self.maxResults = maxResults
+        self.clear()
+
+    def clear(self):
+        """Removes all books."""
+        self.haystacks = {}
+        self.pending = set()
+        self.loaders = []
+        self.years = {}
+        self.yearOf = {}
+        self.postings = None
+        self.vocabulary = None
+        self.results = collections.OrderedDict()
+
+    def add(self, book):
+        """Adds or updates a book."""
+        self.remove(book.id)
+
+        text = self.haystacks[book.id] = haystack(book)
+        if self.postings is not None:
+            self.indexWords(book.id, text)
+
+        if book.year:
+            self.yearOf[book.id] = str(book.year)
+            self.years.setdefault(self.yearOf[book.id], set()).add(book.id)
+
+        for query, matches in self.results.items():
+            if self.matches(book.id, query):
+                matches.add(book.id)
+
+    def defer(self, ids, years, load):
+        """
+        Adds books by id and year, whose haystacks are loaded in the same
+        order by load() on the first search.
+        """
+        ids = list(ids)
+
+        if self.haystacks or self.pending:
+            for id in ids:
+                self.remove(id)
+        self.pending.update(ids)
+
+        for id, year in zip(ids, years):
+            if year:
+                self.yearOf[id] = str(year)
+                self.years.setdefault(self.yearOf[id], set()).add(id)
+
+        self.loaders.append((ids, load))
+
+        # Results of earlier searches are kept up to date.
+        if self.results:
+            self.flush()
+            for query, matches in self.results.items():
+                matches.update(id for id in ids if self.matches(id, query))
+
+    def flush(self):
+        """Loads the haystacks of deferred books."""
+        for ids, load in self.loaders:
+            for id, text in zip(ids, load()):
+                if id in self.pending:
+                    self.haystacks[id] = text
+                    if self.postings is not None:
+                        self.indexWords(id, text)
+
+        self.pending.clear()
+        del self.loaders[:]
+
+    def remove(self, id):
+        """Removes a book, if present."""
+        deferred = id in self.pending
+        self.pending.discard(id)
+        text = self.haystacks.pop(id, None)
+        if text is None and not deferred:
+            return
+
+        if text is not None and self.postings is not None:
+            for word in set(WORD_PATTERN.findall(text)):
+                ids = self.postings[word]
+                ids.discard(id)
+                if not ids:
+                    del self.postings[word]
+                    self.vocabulary = None
+
+        year = self.yearOf.pop(id, None)
+        if year is not None:
+            self.years[year].discard(id)
+
+        for matches in self.results.values():
+            matches.discard(id)
+
+    def indexWords(self, id, text):
+        for word in set(WORD_PATTERN.findall(text)):
+            ids = self.postings.get(word)
+            if ids is None:
+                self.postings[word] = set([id])
+                self.vocabulary = None
+            else:
+                ids.add(id)
+
+    def matches(self, id, query):
+        """Checks if a single book matches."""
+        if query in self.haystacks[id]:
+            return True
+        else:
+            return id in self.years.get(query, ())
+
+    def wordsContaining(self, token):
+        """Generates all indexed words that contain the given token."""
+        if self.vocabulary is None:
+            words = list(self.postings)
+            offsets = []
+            offset = 0
+            for word in words:
+                offsets.append(offset)
+                offset += len(word) + 1
+            self.vocabulary = words, offsets, u"\n".join(words)
+
+        words, offsets, text = self.vocabulary
+
+        position = text.find(token)
+        while position != -1:
+            i = bisect.bisect_right(offsets, position) - 1
+            yield words[i]
+            if i + 1 >= len(offsets):
+                break
+            position = text.find(token, offsets[i + 1])
+
+    def candidates(self, query):
+        """Gets ids that contain the longest word of the query, if selective."""
+        tokens = WORD_PATTERN.findall(query)
+        if not tokens or len(self.haystacks) < self.minIndexed:
+            return None
+
+        if self.postings is None:
+            self.postings = {}
+            for id in self.haystacks:
+                self.indexWords(id, self.haystacks[id])
+
+        # The first and last word of the query may be cut off, so look for
+        # all words that contain it. Give up if that is not selective.
+        limit = len(self.haystacks) // 4
+        candidates = set()
+        for word in self.wordsContaining(max(tokens, key=len)):
+            candidates.update(self.postings[word])
+            if len(candidates) > limit:
+                return None
+        return candidates
+
+    def search(self, query):
+        """Gets the set of ids of all books matching the query."""
+        if query in self.results:
+            return self.results[query]
+
+        self.flush()
+
+        # Verify candidates from the word index or scan everything.
+        candidates = self.candidates(query)
+        if candidates is None:
+            candidates = self.haystacks
+
+        haystacks = self.haystacks
+        matches = set([id for id in candidates if query in haystacks[id]])
+        matches.update(self.years.get(query, ()))
+
+        self.results[query] = matches
+        while len(self.results) > self.maxResults:
+            self.results.popitem(last=False)
+
+        return matches
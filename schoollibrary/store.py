@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# Client for a schoollibrary-server.
+# Copyright (c) 2014-2015 Niklas Fiekas <niklas@backscattering.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have receicved a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+
+COLUMNS = [
+    "id", "etag", "signature", "location", "title", "authors", "topic",
+    "volume", "keywords", "publisher", "placeOfPublication", "year", "isbn",
+    "edition", "lendable", "lent", "lendingUser", "lendingSince",
+    "lendingDays",
+]
+
+# Fixed width columns. None is stored as -1.
+NUMBER_FORMATS = {
+    "id": "<q",
+    "etag": "<q",
+    "year": "<i",
+    "lendable": "<B",
+    "lent": "<B",
+    "lendingSince": "<i",
+    "lendingDays": "<i",
+}
+
+# Text columns are stored as an array of offsets followed by the UTF-8
+# encoded values, each terminated by a null byte, so that a whole column
+# can be decoded at once. None is stored as an empty string.
+STRING_COLUMNS = frozenset(COLUMNS) - frozenset(NUMBER_FORMATS)
+
+MAGIC = b"SLC2"
+
+
+def replace_file(source, destination):
+    """
+    Moves a file over another one. Windows does not allow renaming over an
+    existing file, so it is removed first.
+    """
+    try:
+        os.rename(source, destination)
+    except OSError:
+        if not os.path.exists(destination):
+            raise
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+class Catalogue(object):
+    """
+    A stored catalogue. The file is memory-mapped and single values are
+    read on demand, so that opening it does not depend on its size.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:4] != MAGIC:
+            raise ValueError("Not a catalogue file: %s" % path)
+
+        length, = struct.unpack_from("<I", self.map, 4)
+        header = json.loads(self.map[8:8 + length].decode("utf-8"))
+        if header["size"] != len(self.map):
+            raise ValueError("Truncated catalogue file: %s" % path)
+
+        self.key = header["key"]
+        self.revision = header["revision"]
+        self.count = header["count"]
+        self.offsets = header["offsets"]
+
+    def __len__(self):
+        return self.count
+
+    def value(self, row, column):
+        """Reads a single value."""
+        offset = self.offsets[column]
+
+        if column in NUMBER_FORMATS:
+            format = NUMBER_FORMATS[column]
+            value, = struct.unpack_from(format, self.map, offset + row * struct.calcsize(format))
+            return None if value == -1 else value
+
+        start, end = struct.unpack_from("<II", self.map, offset + row * 4)
+        heap = offset + (self.count + 1) * 4
+        return self.map[heap + start:heap + end - 1].decode("utf-8")
+
+    def column(self, column):
+        """Reads all values of a fixed width column."""
+        format = "<%d%s" % (self.count, NUMBER_FORMATS[column][1])
+        values = struct.unpack_from(format, self.map, self.offsets[column])
+        return [None if value == -1 else value for value in values]
+
+    def strings(self, column):
+        """Reads all values of a text column."""
+        if not self.count:
+            return []
+
+        offset = self.offsets[column]
+        size, = struct.unpack_from("<I", self.map, offset + self.count * 4)
+        heap = offset + (self.count + 1) * 4
+        return self.map[heap:heap + size - 1].decode("utf-8").split(u"\0")
+
+    def row(self, row):
+        """Reads all values of a row, in the order of COLUMNS."""
+        return tuple(self.value(row, column) for column in COLUMNS)
+
+    def rows(self):
+        """Reads all rows in bulk."""
+        return list(zip(*[
+            self.column(column) if column in NUMBER_FORMATS else self.strings(column)
+            for column in COLUMNS
+        ]))
+
+
+def encode_catalogue(key, revision, rows):
+    """Encodes rows of COLUMNS as a catalogue file."""
+    rows = list(rows)
+    sections = []
+    offsets = {}
+    size = 0
+
+    for index, column in enumerate(COLUMNS):
+        values = [row[index] for row in rows]
+
+        if column in NUMBER_FORMATS:
+            format = NUMBER_FORMATS[column]
+            section = struct.pack("<%d%s" % (len(values), format[1]),
+                                  *[-1 if value is None else int(value) for value in values])
+        else:
+            heap = [(value or u"").replace(u"\0", u"").encode("utf-8") + b"\0" for value in values]
+            ends = [0]
+            for value in heap:
+                ends.append(ends[-1] + len(value))
+            section = struct.pack("<%dI" % len(ends), *ends) + b"".join(heap)
+
+        offsets[column] = size
+        sections.append(section)
+        size += len(section)
+
+    # The header refers to the sections by absolute offsets, that depend on
+    # its own length. Grow it until they are stable.
+    length = 0
+    while True:
+        header = json.dumps({
+            "key": key,
+            "revision": revision,
+            "count": len(rows),
+            "offsets": dict((column, 8 + length + offset) for column, offset in offsets.items()),
+            "size": 8 + length + size,
+        }, sort_keys=True).encode("utf-8")
+        if len(header) <= length:
+            header += b" " * (length - len(header))
+            break
+        length = len(header)
+
+    return MAGIC + struct.pack("<I", length) + header + b"".join(sections)
+
+
+class CatalogueStore(object):
+    """
+    Keeps the book lists of servers in memory-mapped files, so that they
+    can be shown before anything is downloaded.
+
+    Each catalogue is stored by a key with the revision it is at. Books are
+    stored as rows of COLUMNS.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def filename(self, key, extension=".catalogue"):
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + extension)
+
+    def journal(self, key):
+        """Gets the lending journal that belongs to a catalogue."""
+        return LendingJournal(self.filename(key, ".journal"))
+
+    def generations(self, key):
+        """Gets the generations and filenames of a catalogue, newest first."""
+        if not os.path.isdir(self.path):
+            return []
+
+        prefix = hashlib.sha1(key.encode("utf-8")).hexdigest() + "."
+        files = []
+        for name in os.listdir(self.path):
+            if name.startswith(prefix) and name.endswith(".catalogue"):
+                generation = name[len(prefix):-len(".catalogue")]
+                if generation.isdigit():
+                    files.append((int(generation), os.path.join(self.path, name)))
+
+        return sorted(files, reverse=True)
+
+    def load(self, key):
+        """Opens the newest stored catalogue, or gets None."""
+        files = self.generations(key)
+        if not files:
+            return None
+
+        catalogue = Catalogue(files[0][1])
+        if catalogue.key != key:
+            return None
+
+        return catalogue
+
+    def save(self, key, revision, rows):
+        """Replaces a catalogue."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # Catalogues that are still mapped cannot be replaced or removed on
+        # Windows, so each save writes a new generation.
+        files = self.generations(key)
+        generation = files[0][0] + 1 if files else 1
+        filename = self.filename(key, ".%d.catalogue" % generation)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(encode_catalogue(key, revision, rows))
+        os.rename(filename + ".tmp", filename)
+
+        # Older generations are removed once they are no longer mapped.
+        for _, old in files:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+class LendingJournal(object):
+    """
+    Lendings and returns that could not be sent yet, stored as one JSON
+    object per line. Entries are appended durably and the file is
+    rewritten as they are sent.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        """Gets the list of entries."""
+        entries = []
+
+        # Finish a rewrite that was interrupted after the old file was
+        # removed.
+        if not os.path.exists(self.filename):
+            if not os.path.exists(self.filename + ".tmp"):
+                return entries
+            os.rename(self.filename + ".tmp", self.filename)
+
+        with open(self.filename, "rb") as f:
+            for line in f:
+                # Skip what is left of an interrupted append.
+                try:
+                    entries.append(json.loads(line.decode("utf-8")))
+                except ValueError:
+                    continue
+
+        return entries
+
+    def append(self, entry):
+        """Appends an entry and waits until it is on disk."""
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self.filename, "ab") as f:
+            f.write(json.dumps(entry).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rewrite(self, entries):
+        """Replaces all entries."""
+        if not entries:
+            for filename in (self.filename, self.filename + ".tmp"):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            return
+
+        with open(self.filename + ".tmp", "wb") as f:
+            for entry in entries:
+                f.write(json.dumps(entry).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(self.filename + ".tmp", self.filename)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Client for a schoollibrary-server.
+# Copyright (c) 2014-2015 Niklas Fiekas <niklas@backscattering.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have receicved a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import codecs
+import json
+import re
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JsonObjectStream(object):
+    """
+    Incrementally decodes the members of a top-level JSON object.
+
+    Bytes can be fed as they arrive. Each call returns the key, value pairs
+    that are complete so far, so that only the current partial member has to
+    be buffered.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = u""
+        self.state = "start"
+        self.key = None
+
+    def feed(self, data):
+        """Feeds bytes and gets the list of newly completed members."""
+        self.buffer += self.utf8.decode(data)
+
+        members = []
+        position = 0
+
+        while True:
+            position = WHITESPACE.match(self.buffer, position).end()
+            if position >= len(self.buffer):
+                break
+
+            char = self.buffer[position]
+
+            if self.state == "start":
+                if char != "{":
+                    raise ValueError("Expected object at %d" % position)
+                position += 1
+                self.state = "key"
+            elif self.state == "key" and char == "}":
+                position += 1
+                self.state = "end"
+            elif self.state == "key":
+                try:
+                    self.key, end = self.decoder.raw_decode(self.buffer, position)
+                except ValueError:
+                    break
+                position = end
+                self.state = "colon"
+            elif self.state == "colon":
+                if char != ":":
+                    raise ValueError("Expected ':' at %d" % position)
+                position += 1
+                self.state = "value"
+            elif self.state == "value":
+                try:
+                    value, end = self.decoder.raw_decode(self.buffer, position)
+                except ValueError:
+                    break
+
+                # A number might continue in the next chunk.
+                if end >= len(self.buffer):
+                    break
+
+                members.append((self.key, value))
+                position = end
+                self.state = "comma"
+            elif self.state == "comma":
+                if char == ",":
+                    self.state = "key"
+                elif char == "}":
+                    self.state = "end"
+                else:
+                    raise ValueError("Expected ',' or '}' at %d" % position)
+                position += 1
+            else:
+                raise ValueError("Extra data at %d" % position)
+
+        self.buffer = self.buffer[position:]
+        return members
+
+    def finish(self):
+        """Checks that the object is complete."""
+        if self.state != "end" or self.buffer.strip() or self.utf8.decode(b"", True):
+            raise ValueError("Incomplete JSON object")
@@ -21,14 +21,26 @@ from PySide.QtCore import *
 from PySide.QtGui import *
 from PySide.QtNetwork import *
 
+from schoollibrary import network
+
 
 class UserListModel(QAbstractListModel):
+    """
+    Lists users of the directory.
+
+    The shared model loads the whole directory, if it has no more than
+    limit entries. Otherwise it is incomplete and dialogs search with
+    their own models as the user name is typed.
+    """
 
-    def __init__(self, app):
+    def __init__(self, app, limit=1000):
         super(UserListModel, self).__init__()
         self.app = app
-        self.app.network.finished.connect(self.onNetworkRequestFinished)
         self.cache = []
+        self.limit = limit
+        self.complete = True
+        self.prefix = None
+        self.ticket = None
 
     def index(self, row, column, parent=QModelIndex()):
         if parent.isValid() or not self.hasIndex(row, column, parent):
@@ -47,12 +59,30 @@ class UserListModel(QAbstractListModel):
         elif role == Qt.EditRole:
             return user
 
-    def reload(self):
-        request = QNetworkRequest(self.app.login.getUrl("/users/"))
-        self.app.network.get(request)
+    def reload(self, callback=None):
+        return self.query("", callback)
+
+    def search(self, prefix):
+        """Looks up the users starting with the prefix, unless already done."""
+        if prefix != self.prefix:
+            self.query(prefix)
+
+    def query(self, prefix, callback=None):
+        url = self.app.login.getUrl("/users/")
+        url.addQueryItem("prefix", prefix)
+        url.addQueryItem("limit", str(self.limit))
+
+        self.prefix = prefix
+        self.ticket = self.app.network.http("GET", QNetworkRequest(url), callback=network.chain(self.onUsersReply, callback))
+        return self.ticket
 
-    def onNetworkRequestFinished(self, reply):
-        if not reply.request().url().path().endswith("/users/"):
+    def onUsersReply(self, reply):
+        # Ignore replies that have been superseded by another query.
+        if reply.request().attribute(network.Ticket) != self.ticket:
+            return
+
+        self.ticket = None
+        if reply.error() != QNetworkReply.NoError:
             return
 
         self.beginResetModel()
@@ -61,6 +91,53 @@ class UserListModel(QAbstractListModel):
         while reply.canReadLine():
             self.cache.append(str(reply.readLine()).strip())
 
-        self.cache.sort()
+        # The server sorts and counts the matching users.
+        if reply.hasRawHeader(QByteArray("X-Total-Count")):
+            self.complete = int(reply.rawHeader(QByteArray("X-Total-Count")).data()) <= len(self.cache)
+        else:
+            self.cache.sort()
+            self.complete = True
 
         self.endResetModel()
+
+
+class UserComboBox(QComboBox):
+    """
+    Selects a user. Offers the shared user list, if it is complete, or
+    completes from searches in the directory otherwise.
+    """
+
+    def __init__(self, app, parent=None):
+        super(UserComboBox, self).__init__(parent)
+        self.app = app
+
+        self.setEditable(True)
+        self.setInsertPolicy(QComboBox.NoInsert)
+
+        if self.app.users.complete:
+            self.setModel(self.app.users)
+            self.setCurrentIndex(-1)
+            return
+
+        self.searchModel = UserListModel(self.app, 50)
+        self.searchModel.modelReset.connect(self.onSearchModelReset)
+
+        searchCompleter = QCompleter(self.searchModel, self)
+        searchCompleter.setCaseSensitivity(Qt.CaseInsensitive)
+        self.setCompleter(searchCompleter)
+
+        # Wait for a pause in typing before searching.
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(250)
+        self.searchTimer.timeout.connect(self.onSearchTimeout)
+        self.editTextChanged.connect(lambda text: self.searchTimer.start())
+
+    def onSearchTimeout(self):
+        prefix = self.currentText().strip()
+        if prefix:
+            self.searchModel.search(prefix)
+
+    def onSearchModelReset(self):
+        if self.lineEdit().hasFocus():
+            self.completer().complete()
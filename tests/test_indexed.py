@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+
+from schoollibrary import indexed
+
+
+class IndexedOrderedDictTestCase(unittest.TestCase):
+
+    def assertConsistent(self, iod, keys):
+        self.assertEqual(list(iod), keys)
+        self.assertEqual(list(reversed(iod)), keys[::-1])
+        self.assertEqual(len(iod), len(keys))
+        for position, key in enumerate(keys):
+            self.assertEqual(iod.keys()[position], key)
+            self.assertEqual(iod.values()[position], iod[key])
+            self.assertEqual(iod.items()[position], (key, iod[key]))
+            self.assertEqual(iod.keys().index(key), position)
+        self.assertEqual(iod.keys()[1:-1], keys[1:-1])
+
+    def test_order_and_index(self):
+        iod = indexed.IndexedOrderedDict()
+        for key in range(10):
+            iod[key] = key * 2
+        iod[3] = "three"
+
+        self.assertConsistent(iod, list(range(10)))
+        self.assertEqual(iod.values()[3], "three")
+
+    def test_delete_with_tombstones(self):
+        iod = indexed.IndexedOrderedDict((key, key) for key in range(20))
+        keys = list(range(20))
+
+        for key in [5, 7, 0]:
+            del iod[key]
+            keys.remove(key)
+            self.assertConsistent(iod, keys)
+
+        # Deleting the last key also drops tombstones in front of it.
+        del iod[19]
+        keys.remove(19)
+        self.assertConsistent(iod, keys)
+
+        iod[5] = "again"
+        keys.append(5)
+        self.assertConsistent(iod, keys)
+
+    def test_compaction(self):
+        iod = indexed.IndexedOrderedDict((key, key) for key in range(100))
+        keys = list(range(100))
+
+        # Enough deletes to compact the key list several times.
+        for key in range(0, 90, 2):
+            del iod[key]
+            keys.remove(key)
+        self.assertConsistent(iod, keys)
+
+        iod._compact()
+        self.assertEqual(iod._holes, [])
+        self.assertConsistent(iod, keys)
+
+    def test_negative_index(self):
+        iod = indexed.IndexedOrderedDict((key, key) for key in range(10))
+        del iod[4]
+        self.assertEqual(iod.keys()[-1], 9)
+        self.assertEqual(iod.keys()[-6], 3)
+        self.assertRaises(IndexError, lambda: iod.keys()[9])
+
+    def test_popitem_and_move_to_end(self):
+        iod = indexed.IndexedOrderedDict((key, key) for key in range(5))
+        del iod[1]
+        self.assertEqual(iod.popitem(last=False), (0, 0))
+        self.assertEqual(iod.popitem(), (4, 4))
+
+        iod.move_to_end(2)
+        self.assertConsistent(iod, [3, 2])
+        iod.move_to_end(2, last=False)
+        self.assertConsistent(iod, [2, 3])
+
+    def test_extend(self):
+        iod = indexed.IndexedOrderedDict()
+        iod.extend(range(10), range(100, 110))
+        self.assertConsistent(iod, list(range(10)))
+        self.assertEqual(iod[3], 103)
+
+        # Present and duplicate keys are set one by one.
+        del iod[4]
+        iod.extend([3, 20, 20], ["three", 1, 2])
+        self.assertConsistent(iod, [0, 1, 2, 3, 5, 6, 7, 8, 9, 20])
+        self.assertEqual(iod[3], "three")
+        self.assertEqual(iod[20], 2)
+
+    def test_random_operations(self):
+        rng = random.Random(4)
+        iod = indexed.IndexedOrderedDict()
+        keys = []
+
+        for step in range(2000):
+            if keys and rng.random() < 0.45:
+                key = rng.choice(keys)
+                del iod[key]
+                keys.remove(key)
+            else:
+                key = rng.randint(0, 500)
+                if key not in iod:
+                    keys.append(key)
+                iod[key] = step
+
+            if step % 50 == 0:
+                self.assertConsistent(iod, keys)
+
+        self.assertConsistent(iod, keys)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+
+from schoollibrary import search
+
+
+WORDS = [u"der", u"und", u"die", u"Faust", u"Götz", u"Räuber", u"Physik", u"Chemie", u"Band", u"Klett"]
+
+
+class Book(object):
+
+    def __init__(self, id, rng):
+        self.id = id
+        for field in search.HAYSTACK_FIELDS:
+            setattr(self, field, u" ".join(rng.choice(WORDS) for i in range(rng.randint(0, 3))))
+        self.year = rng.choice([None, 1999, 2004])
+        self.lendingUser = rng.choice([None, u"Müller"])
+
+
+class SearchIndexTestCase(unittest.TestCase):
+
+    QUERIES = [u"der", u"faust", u"götz r", u"ysi", u"ett\nder", u"1999", u"Müller", u"müller", u"xyz", u"e"]
+
+    def assertMatchesScan(self, index, books):
+        for query in self.QUERIES:
+            expected = set(
+                book.id for book in books.values()
+                if query in search.haystack(book) or str(book.year) == query)
+            self.assertEqual(index.search(query), expected, query)
+
+    def check(self, minIndexed):
+        rng = random.Random(minIndexed)
+        index = search.SearchIndex(minIndexed=minIndexed, maxResults=4)
+        books = {}
+
+        # Deferred books are loaded on the first search.
+        deferred = [Book(id, rng) for id in range(50)]
+        for book in deferred:
+            books[book.id] = book
+        index.defer([book.id for book in deferred], [book.year for book in deferred], lambda: [search.haystack(book) for book in deferred])
+        self.assertMatchesScan(index, books)
+
+        for step in range(300):
+            id = rng.randint(0, 80)
+            if id in books and rng.random() < 0.4:
+                del books[id]
+                index.remove(id)
+            else:
+                books[id] = Book(id, rng)
+                index.add(books[id])
+
+            if step % 30 == 0:
+                self.assertMatchesScan(index, books)
+
+        # Deferring after searches updates the kept results.
+        deferred = [Book(id, rng) for id in range(40, 60)]
+        for book in deferred:
+            books[book.id] = book
+        index.defer([book.id for book in deferred], [book.year for book in deferred], lambda: [search.haystack(book) for book in deferred])
+        self.assertMatchesScan(index, books)
+
+    def test_scan(self):
+        self.check(minIndexed=10000)
+
+    def test_word_index(self):
+        self.check(minIndexed=1)
+
+    def test_remove_deferred(self):
+        rng = random.Random(1)
+        index = search.SearchIndex(minIndexed=1)
+        books = [Book(id, rng) for id in range(10)]
+        index.defer([book.id for book in books], [book.year for book in books], lambda: [search.haystack(book) for book in books])
+        index.remove(3)
+        self.assertFalse(3 in index.search(u""))
+        self.assertEqual(len(index.search(u"")), 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
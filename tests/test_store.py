@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from schoollibrary import store
+
+
+class LendingJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = store.LendingJournal(os.path.join(self.path, "test.journal"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_rewrite_existing(self):
+        self.journal.append({"id": 1, "user": u"müller"})
+        self.journal.append({"id": 2, "user": None})
+        self.journal.append({"id": 3, "user": u"schmidt"})
+
+        self.journal.rewrite([{"id": 3, "user": u"schmidt"}])
+        self.assertEqual(self.journal.load(), [{"id": 3, "user": u"schmidt"}])
+        self.assertFalse(os.path.exists(self.journal.filename + ".tmp"))
+
+        self.journal.rewrite([])
+        self.assertEqual(self.journal.load(), [])
+        self.assertFalse(os.path.exists(self.journal.filename))
+
+    def test_interrupted_rewrite(self):
+        self.journal.append({"id": 1, "user": u"müller"})
+        os.rename(self.journal.filename, self.journal.filename + ".tmp")
+
+        self.assertEqual(self.journal.load(), [{"id": 1, "user": u"müller"}])
+        self.journal.append({"id": 2, "user": None})
+        self.assertEqual(len(self.journal.load()), 2)
+
+
+class CatalogueStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = store.CatalogueStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def row(self, id, title):
+        row = [None] * len(store.COLUMNS)
+        row[store.COLUMNS.index("id")] = id
+        row[store.COLUMNS.index("title")] = title
+        for column in ["lendable", "lent"]:
+            row[store.COLUMNS.index(column)] = False
+        return row
+
+    def test_save_while_mapped(self):
+        self.store.save(u"http://localhost/books/", 1, [self.row(1, u"Faust")])
+        mapped = self.store.load(u"http://localhost/books/")
+
+        self.store.save(u"http://localhost/books/", 2, [self.row(1, u"Faust"), self.row(2, u"Götz")])
+        catalogue = self.store.load(u"http://localhost/books/")
+        self.assertEqual(catalogue.revision, 2)
+        self.assertEqual(catalogue.strings("title"), [u"Faust", u"Götz"])
+        self.assertEqual(mapped.value(0, "title"), u"Faust")
+
+
+if __name__ == "__main__":
+    unittest.main()
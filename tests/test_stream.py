@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+import random
+import unittest
+
+from schoollibrary import stream
+
+
+DOCUMENT = {
+    u"10000": {u"title": u"Die Räuber {1}", u"authors": u"Schiller, \"Friedrich\"", u"year": 1781},
+    u"10001": {u"title": u"Faust\n\\ Teil 1 }", u"keywords": u"Drama, [Tragödie]", u"year": None},
+    u"10002": {u"title": u"été 📚", u"lent": True, u"lending": {u"user": u"müller", u"days": 14}},
+    u"{\"key\"}": [1, 2.5, -3e2, u"}", {}],
+    u"10003": 12345678,
+}
+
+
+class JsonObjectStreamTestCase(unittest.TestCase):
+
+    def decode(self, chunks):
+        decoder = stream.JsonObjectStream()
+        members = []
+        for chunk in chunks:
+            members.extend(decoder.feed(chunk))
+        decoder.finish()
+        return members
+
+    def test_whole(self):
+        data = json.dumps(DOCUMENT, indent=1, ensure_ascii=False).encode("utf-8")
+        self.assertEqual(dict(self.decode([data])), DOCUMENT)
+
+    def test_random_splits(self):
+        rng = random.Random(8)
+        for ensure_ascii in (True, False):
+            data = json.dumps(DOCUMENT, ensure_ascii=ensure_ascii).encode("utf-8")
+            for attempt in range(200):
+                cuts = sorted(rng.sample(range(1, len(data)), rng.randint(1, 20)))
+                chunks = [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+                members = self.decode(chunks)
+                self.assertEqual(dict(members), DOCUMENT)
+                self.assertEqual(len(members), len(DOCUMENT))
+
+    def test_single_bytes(self):
+        data = json.dumps(DOCUMENT, ensure_ascii=False).encode("utf-8")
+        self.assertEqual(dict(self.decode([data[i:i + 1] for i in range(len(data))])), DOCUMENT)
+
+    def test_empty(self):
+        self.assertEqual(self.decode([b" {", b" } "]), [])
+
+    def test_incomplete(self):
+        decoder = stream.JsonObjectStream()
+        decoder.feed(b'{"1": {"title": "x"}, "2": 1')
+        self.assertRaises(ValueError, decoder.finish)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.decode, [b'["not", "an", "object"]'])
+        self.assertRaises(ValueError, self.decode, [b'{"1" 2}'])
+        self.assertRaises(ValueError, self.decode, [b'{"1": 2} {}'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,80 +3,141 @@
 use strict;
 use Env qw(HTPASSWD HTPASSWD_ALLOW_PLAIN HTGROUPS);
 
-# Get command line arguments.
-if ($#ARGV != 1) {
-    exit;
-}
-my $username = $ARGV[0];
-my $password = $ARGV[1];
+# Usage: auth-htpasswd.pl <username> <password>
+#
+# Prints the groups of the user, one group per line, if the password is
+# correct.
+#
+# Usage: auth-htpasswd.pl --serve
+#
+# Keeps running and answers one query per line on stdin. A query is the
+# URI encoded username and password separated by a space. The answer is
+# the list of groups, one group per line, terminated by an empty line.
+# The files are read once and reloaded when they change.
 
-# Remove the local hostname suffix from the username.
+# Get the local hostname suffix, that is removed from usernames.
 my $hostname = `hostname -d` || `hostname`;
 chop($hostname);
 my $pattern = quotemeta('@' . $hostname);
-$username =~ s/$pattern$//;
 
-# Check the password.
-my $user_found = 0;
-open my $htpasswd_fh, $HTPASSWD or exit;
-while (<$htpasswd_fh>) {
-    chop;
-    my @record = split(/:/, $_, 2);
-
-    if ($record[0] eq $username) {
-        if (index($record[1], '$apr1$') == 0) {
-            # Mechanism: Apache MD5 hash.
-            require Crypt::PasswdMD5;
-
-            my $salt = $record[1];
-            $salt =~ s/^\$apr1\$//;
-            $salt =~ s/^(.*)\$/$1/;
-            $salt = substr($salt, 0, 8);
-
-            if (Crypt::PasswdMD5::apache_md5_crypt($password, $salt) eq $record[1]) {
-                print "user\n";
-            } else {
-                exit;
-            }
-        } elsif (index($record[1], '{SHA}') == 0) {
-            # Mechanism: SHA-1.
-            require Digest::SHA;
-            require MIME::Base64;
-
-            if ('{SHA}' . MIME::Base64::encode_base64(Digest::SHA::sha1($password), '') eq $record[1]) {
-                print "user\n";
-            } else {
-                exit;
-            }
-        } else {
-            # Mechanism: crypt.
-            if (crypt($password, $record[1]) eq $record[1]) {
-                print "user\n";
-            } else {
-                # Mechanism: plain text.
-                if ($HTPASSWD_ALLOW_PLAIN && $password eq $record[1]) {
-                    print "user\n";
-                } else {
-                    exit;
-                }
+sub check_password {
+    my ($password, $hash) = @_;
+
+    if (index($hash, '$apr1$') == 0) {
+        # Mechanism: Apache MD5 hash.
+        require Crypt::PasswdMD5;
+
+        my $salt = $hash;
+        $salt =~ s/^\$apr1\$//;
+        $salt =~ s/^(.*)\$/$1/;
+        $salt = substr($salt, 0, 8);
+
+        return Crypt::PasswdMD5::apache_md5_crypt($password, $salt) eq $hash;
+    } elsif (index($hash, '{SHA}') == 0) {
+        # Mechanism: SHA-1.
+        require Digest::SHA;
+        require MIME::Base64;
+
+        return '{SHA}' . MIME::Base64::encode_base64(Digest::SHA::sha1($password), '') eq $hash;
+    } elsif (crypt($password, $hash) eq $hash) {
+        # Mechanism: crypt.
+        return 1;
+    } else {
+        # Mechanism: plain text.
+        return $HTPASSWD_ALLOW_PLAIN && $password eq $hash;
+    }
+}
+
+sub read_htpasswd {
+    my %hashes;
+
+    open my $htpasswd_fh, $HTPASSWD or return %hashes;
+    while (<$htpasswd_fh>) {
+        chop;
+        my @record = split(/:/, $_, 2);
+
+        # The first record of a user counts.
+        if (defined $record[1] && !exists $hashes{$record[0]}) {
+            $hashes{$record[0]} = $record[1];
+        }
+    }
+
+    return %hashes;
+}
+
+sub read_htgroups {
+    my %groups;
+
+    open my $htgroups_fh, $HTGROUPS or return %groups;
+    while (<$htgroups_fh>) {
+        chop;
+        my @record = split(/:\s+/, $_, 2);
+        next unless defined $record[1];
+        my @users = split(/\s+/, $record[1]);
+
+        foreach my $user (@users) {
+            if ($record[0] ne 'user') {
+                push @{$groups{$user}}, $record[0];
             }
         }
-        $user_found = 1;
-        last;
     }
+
+    return %groups;
 }
-exit unless $user_found;
 
-# Get groups.
-open my $htgroups_fh, $HTGROUPS or exit;
-while (<$htgroups_fh>) {
-    chop;
-    my @record = split(/:\s+/, $_, 2);
-    my @users = split(/\s+/, $record[1]);
-
-    foreach my $user (@users) {
-        if ($user eq $username && $record[0] ne 'user') {
-            print "$record[0]\n";
+if ($#ARGV == 0 && $ARGV[0] eq '--serve') {
+    $| = 1;
+
+    my %hashes;
+    my %groups;
+    my $stamp = '';
+
+    while (my $line = <STDIN>) {
+        chomp($line);
+        my ($username, $password) = map {
+            my $value = $_;
+            $value =~ s/%([0-9A-Fa-f]{2})/chr(hex($1))/eg;
+            $value;
+        } (split(/ /, $line, 2), '', '')[0, 1];
+        $username =~ s/$pattern$//;
+
+        # Reload the files if they changed.
+        my $current = join(',', map {
+            my @stat = stat($_);
+            @stat ? "$stat[1]:$stat[7]:$stat[9]" : '-';
+        } ($HTPASSWD, $HTGROUPS));
+        if ($current ne $stamp) {
+            %hashes = read_htpasswd();
+            %groups = read_htgroups();
+            $stamp = $current;
         }
+
+        if (exists $hashes{$username} && check_password($password, $hashes{$username})) {
+            print "user\n";
+            print "$_\n" foreach @{$groups{$username} || []};
+        }
+
+        print "\n";
     }
+
+    exit;
 }
+
+# Get command line arguments.
+if ($#ARGV != 1) {
+    exit;
+}
+my $username = $ARGV[0];
+my $password = $ARGV[1];
+
+# Remove the local hostname suffix from the username.
+$username =~ s/$pattern$//;
+
+# Check the password.
+my %hashes = read_htpasswd();
+exit unless exists $hashes{$username} && check_password($password, $hashes{$username});
+print "user\n";
+
+# Get groups.
+my %groups = read_htgroups();
+print "$_\n" foreach @{$groups{$username} || []};
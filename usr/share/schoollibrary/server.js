@@ -19,6 +19,11 @@ var bookSchema = mongoose.Schema({
         type: Number,
         required: true
     },
+    revision: {
+        type: Number,
+        default: 0,
+        index: true
+    },
     title: {
         type: String,
         required: true,
@@ -125,6 +130,160 @@ bookSchema.plugin(mongooseAutoIncrement.plugin, {
 
 var Book = mongoose.model('Book', bookSchema);
 
+var revisionSchema = mongoose.Schema({
+    _id: String,
+    value: {
+        type: Number,
+        default: 0
+    }
+});
+
+var Revision = mongoose.model('Revision', revisionSchema);
+
+var tombstoneSchema = mongoose.Schema({
+    _id: Number,
+    revision: {
+        type: Number,
+        required: true,
+        index: true
+    }
+});
+
+var Tombstone = mongoose.model('Tombstone', tombstoneSchema);
+
+// Prepares a plain book object for a response, like the virtuals of the
+// model would.
+function toClient(book, req) {
+    book.id = String(book._id);
+    book.lent = !! (book.lending && book.lending.user);
+
+    if (!req.library_lend) {
+        delete book.lending;
+    }
+
+    return book;
+}
+
+// Writes the books of a lean cursor as a JSON object by id, without
+// collecting them first. Members are written in chunks of about 16 KB and
+// reading pauses while the response is congested.
+function streamBooks(cursor, req, res) {
+    var chunk = '{';
+    var first = true;
+    var finished = false;
+
+    res.set('Content-Type', 'application/json; charset=utf-8');
+
+    cursor.on('data', function (book) {
+        chunk += (first ? '' : ',') + JSON.stringify(String(book._id)) + ':' + JSON.stringify(toClient(book, req));
+        first = false;
+
+        if (chunk.length >= 16384) {
+            var drained = res.write(chunk);
+            chunk = '';
+
+            if (!drained) {
+                cursor.pause();
+                res.once('drain', function () {
+                    cursor.resume();
+                });
+            }
+        }
+    });
+
+    cursor.on('end', function () {
+        finished = true;
+        res.end(chunk + '}');
+    });
+
+    // Headers are already sent, so abort the response to make the client
+    // see an incomplete list.
+    cursor.on('error', function (err) {
+        console.log(err);
+        finished = true;
+        req.socket.destroy();
+    });
+
+    res.on('close', function () {
+        if (!finished) {
+            finished = true;
+            cursor.close(function () { });
+        }
+    });
+}
+
+// The revision counter is kept in memory, so that it is known which
+// reserved revisions are still being written. Revisions are reserved before
+// a write, but writes can finish in any order.
+var lastRevision = null;
+var pendingRevisions = { };
+var revisionWaiters = null;
+
+function loadRevision(callback) {
+    if (lastRevision !== null) {
+        return callback(null);
+    }
+
+    if (revisionWaiters) {
+        return revisionWaiters.push(callback);
+    }
+
+    revisionWaiters = [callback];
+    Revision.findById('books', function (err, revision) {
+        var waiters = revisionWaiters;
+        revisionWaiters = null;
+
+        if (!err && lastRevision === null) {
+            lastRevision = revision ? revision.value : 0;
+        }
+
+        waiters.forEach(function (waiter) {
+            waiter(err);
+        });
+    });
+}
+
+// Gets the highest revision up to which all writes have finished, so that
+// deltas never skip a change that is still being written.
+function currentRevision(callback) {
+    loadRevision(function (err) {
+        if (err) return callback(err);
+
+        var committed = lastRevision;
+        Object.keys(pendingRevisions).forEach(function (revision) {
+            committed = Math.min(committed, parseInt(revision, 10) - 1);
+        });
+        callback(null, committed);
+    });
+}
+
+// Reserves a revision for a write. The counter is stored before the write,
+// so that revisions are not reused after a restart. finishRevision() has to
+// be called when the write succeeded or failed.
+function nextRevision(callback) {
+    loadRevision(function (err) {
+        if (err) return callback(err);
+
+        var revision = ++lastRevision;
+        pendingRevisions[revision] = true;
+
+        Revision.findByIdAndUpdate('books', { $max: { value: revision } }, {
+            upsert: true
+        }, function (err) {
+            if (err) {
+                finishRevision(revision);
+                return callback(err);
+            }
+
+            callback(null, revision);
+        });
+    });
+}
+
+function finishRevision(revision) {
+    delete pendingRevisions[revision];
+}
+
 var authHook = '/etc/schoollibrary/auth.sh';
 if (fs.existsSync('auth.sh')) {
     authHook = './auth.sh';
@@ -134,14 +293,191 @@ if (fs.existsSync('users.sh')) {
     usersHook = './users.sh';
 }
 
+// Reads a number of seconds from the environment. Values that are not a
+// non-negative integer fall back to the default.
+function envSeconds(name, fallback) {
+    var value = process.env[name];
+    if (!/^\s*\d+\s*$/.test(value || '')) {
+        if (value) {
+            console.log('Ignoring invalid ' + name + ': ' + value);
+        }
+        return 1000 * fallback;
+    }
+    return 1000 * parseInt(value, 10);
+}
+
+// Successful authentications are cached by a salted hash of the
+// credentials, so that the auth hook is not spawned for every request.
+var authCacheTtl = envSeconds('AUTH_CACHE_TTL', 300);
+var authCacheSize = 1000;
+var authCacheSalt = crypto.randomBytes(32);
+var authCache = new Map();
+
+function authCacheKey(credentials) {
+    return crypto.createHmac('sha256', authCacheSalt)
+        .update(credentials.username + '\0' + credentials.password)
+        .digest('hex');
+}
+
+function authCacheGet(key) {
+    var entry = authCache.get(key);
+    if (!entry) {
+        return null;
+    }
+
+    authCache.delete(key);
+    if (entry.expires < Date.now()) {
+        return null;
+    }
+
+    // Keep recently used entries at the end.
+    authCache.set(key, entry);
+    return entry.groups;
+}
+
+function authCacheSet(key, groups) {
+    if (authCacheTtl <= 0) {
+        return;
+    }
+
+    authCache.delete(key);
+    authCache.set(key, {
+        groups: groups,
+        expires: Date.now() + authCacheTtl
+    });
+
+    if (authCache.size > authCacheSize) {
+        authCache.delete(authCache.keys().next().value);
+    }
+}
+
+// The user directory is cached as a list sorted case insensitively, so
+// that prefixes can be looked up by bisection.
+var usersCacheTtl = envSeconds('USERS_CACHE_TTL', 300);
+var usersCache = null;
+var usersLoading = null;
+
+function loadUsers(callback) {
+    if (usersCache && usersCache.expires >= Date.now()) {
+        return callback(usersCache);
+    }
+
+    // Let concurrent requests wait for the same run of the users hook.
+    if (usersLoading) {
+        return usersLoading.push(callback);
+    }
+    usersLoading = [callback];
+
+    var users = [];
+    var usersProcess = childProcess.spawn(usersHook);
+
+    byline(usersProcess.stdout, {
+        keepEmptyLines: false
+    }).on('data', function (line) {
+        users.push(line.toString('utf-8').trim());
+    });
+
+    usersProcess.on('close', function () {
+        users.sort(function (a, b) {
+            a = a.toLowerCase();
+            b = b.toLowerCase();
+            return a < b ? -1 : (a > b ? 1 : 0);
+        });
+
+        var loaded = {
+            users: users,
+            keys: users.map(function (user) {
+                return user.toLowerCase();
+            }),
+            etag: '"' + crypto.createHash('sha1').update(users.join('\n')).digest('hex') + '"',
+            expires: Date.now() + usersCacheTtl
+        };
+
+        var callbacks = usersLoading;
+        usersLoading = null;
+        if (usersCacheTtl > 0) {
+            usersCache = loaded;
+        }
+
+        callbacks.forEach(function (callback) {
+            callback(loaded);
+        });
+    });
+}
+
+function lowerBound(keys, key) {
+    var lo = 0, hi = keys.length;
+    while (lo < hi) {
+        var mid = (lo + hi) >>> 1;
+        if (keys[mid] < key) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// Forget cached authentications and users when the configuration changes.
+function watchConfigFile(path) {
+    try {
+        var watcher = fs.watch(path, { persistent: false }, function (event) {
+            authCache.clear();
+            usersCache = null;
+
+            // Editors replace the file, so the watch has to be renewed.
+            if (event === 'rename') {
+                watcher.close();
+                setTimeout(function () {
+                    watchConfigFile(path);
+                }, 1000);
+            }
+        });
+    } catch (err) {
+        // Not present. Rely on the TTL.
+    }
+}
+
+var authConfig = authHook === './auth.sh' ? 'etc/schoollibrary/' : '/etc/schoollibrary/';
+var htpasswd = process.env.HTPASSWD || authConfig + 'htpasswd';
+var htgroups = process.env.HTGROUPS || authConfig + 'htgroups';
+[authHook, usersHook, htpasswd, htgroups].forEach(watchConfigFile);
+
+// Connection statistics, shown to admins with GET /stats, to check that
+// clients reuse their connections.
+var stats = {
+    since: new Date(),
+    connections: 0,
+    open: 0,
+    requests: 0,
+    // Closed connections by the number of requests they served, rounded
+    // down to a power of two.
+    requestsPerConnection: {}
+};
+
 var app = express();
+app.use(function (req, res, next) {
+    stats.requests++;
+    req.socket.libraryRequests = (req.socket.libraryRequests || 0) + 1;
+    next();
+});
 app.use(bodyParser.json());
 app.use(bodyParser.urlencoded({extended: false}));
 app.use(compression());
 app.use(connectLogger());
 
-app.use(connectBasicAuth(function (credentials, req, res, next) {
-    req.groups = [];
+function authorize(req, groups) {
+    req.groups = groups;
+    req.library_admin = req.groups.indexOf('library_admin') !== -1;
+    req.library_modify = req.library_admin || req.groups.indexOf('library_modify') !== -1;
+    req.library_delete = req.library_admin || req.groups.indexOf('library_delete') !== -1;
+    req.library_lend = req.library_admin || req.groups.indexOf('library_lend') !== -1;
+}
+
+// Runs the auth hook once for the given credentials. It lists the groups of
+// the user, one per line.
+function spawnAuthHook(credentials, callback) {
+    var groups = [];
 
     var authProcess = childProcess.spawn(authHook, [
         credentials.username,
@@ -153,20 +489,133 @@ app.use(connectBasicAuth(function (credentials, req, res, next) {
     });
 
     auth.on('data', function (group) {
-        req.groups.push(group.toString('utf-8'));
+        groups.push(group.toString('utf-8'));
     });
 
     authProcess.on('close', function () {
-        if (req.groups.length) {
-            req.user = credentials.username;
+        callback(groups);
+    });
+}
 
-            req.library_admin = req.groups.indexOf('library_admin') !== -1;
-            req.library_modify = req.library_admin || req.groups.indexOf('library_modify') !== -1;
-            req.library_delete = req.library_admin || req.groups.indexOf('library_delete') !== -1;
-            req.library_lend = req.library_admin || req.groups.indexOf('library_lend') !== -1;
+// A long running auth helper, that answers queries of URI encoded
+// credentials line by line. Each answer is a list of groups, one per line,
+// terminated by an empty line.
+function AuthHelper(command) {
+    this.command = command;
+    this.process = null;
+    this.pending = [];
+    this.groups = [];
+}
+
+AuthHelper.prototype.start = function () {
+    var self = this;
+    var env = { };
+    Object.keys(process.env).forEach(function (key) {
+        env[key] = process.env[key];
+    });
+    env.HTPASSWD = htpasswd;
+    env.HTGROUPS = htgroups;
+
+    var helper = this.process = childProcess.spawn(this.command, ['--serve'], {
+        stdio: ['pipe', 'pipe', 'inherit'],
+        env: env
+    });
+
+    byline(helper.stdout, {
+        keepEmptyLines: true
+    }).on('data', function (line) {
+        line = line.toString('utf-8');
+        if (line) {
+            self.groups.push(line);
+        } else {
+            var groups = self.groups;
+            self.groups = [];
+
+            // Ignore answers that nobody asked for.
+            var callback = self.pending.shift();
+            if (callback) {
+                callback(null, groups);
+            }
+        }
+    });
+
+    // Errors writing to a helper that died are handled on exit.
+    helper.stdin.on('error', function () { });
+
+    helper.on('error', function () { });
+
+    helper.on('close', function () {
+        if (self.process !== helper) {
+            return;
+        }
+
+        var pending = self.pending;
+        self.process = null;
+        self.pending = [];
+        self.groups = [];
+
+        pending.forEach(function (callback) {
+            callback(new Error('Auth helper exited'));
+        });
+    });
+};
+
+AuthHelper.prototype.query = function (credentials, callback) {
+    if (!this.process) {
+        this.start();
+    }
+
+    this.pending.push(callback);
+    this.process.stdin.write(
+        encodeURIComponent(credentials.username) + ' ' +
+        encodeURIComponent(credentials.password) + '\n');
+};
+
+var authHelpers = [];
+if (process.env.AUTH_HELPER) {
+    for (var i = 0; i < (parseInt(process.env.AUTH_HELPERS, 10) || 2); i++) {
+        authHelpers.push(new AuthHelper(process.env.AUTH_HELPER));
+    }
+}
+
+// Asks the least busy auth helper. Falls back to the auth hook if there
+// are no helpers or the helper failed.
+function authenticate(credentials, callback) {
+    if (!authHelpers.length) {
+        return spawnAuthHook(credentials, callback);
+    }
+
+    var helper = authHelpers.reduce(function (best, helper) {
+        return helper.pending.length < best.pending.length ? helper : best;
+    });
+
+    helper.query(credentials, function (err, groups) {
+        if (err) {
+            return spawnAuthHook(credentials, callback);
+        }
+
+        callback(groups);
+    });
+}
+
+app.use(connectBasicAuth(function (credentials, req, res, next) {
+    var key = authCacheKey(credentials);
+    var groups = authCacheGet(key);
+    if (groups) {
+        req.user = credentials.username;
+        authorize(req, groups);
+        return next();
+    }
+
+    authenticate(credentials, function (groups) {
+        if (groups.length) {
+            req.user = credentials.username;
+            authorize(req, groups);
+            authCacheSet(key, groups);
 
             next();
         } else {
+            req.groups = [];
             next('Authentication required');
         }
     });
@@ -211,12 +660,111 @@ app.all('*', (function () {
     };
 })());
 
+// Clients subscribed to book changes with GET /events.
+var eventClients = [];
+
+function sendEvent(res, event, data) {
+    res.write('event: ' + event + '\ndata: ' + data + '\n\n');
+    res.flush();
+}
+
+// Sends a changed book to all subscribers. Lendings are only shown to
+// those that may see them.
+function broadcastBook(book) {
+    var full = null;
+    var limited = null;
+
+    eventClients.forEach(function (client) {
+        if (client.req.library_lend) {
+            full = full || JSON.stringify({
+                revision: book.revision,
+                book: toClient(book.toObject(), { library_lend: true })
+            });
+            sendEvent(client.res, 'book', full);
+        } else {
+            limited = limited || JSON.stringify({
+                revision: book.revision,
+                book: toClient(book.toObject(), { library_lend: false })
+            });
+            sendEvent(client.res, 'book', limited);
+        }
+    });
+}
+
+function broadcastDelete(id, revision) {
+    var data = JSON.stringify({ revision: revision, id: id });
+    eventClients.forEach(function (client) {
+        sendEvent(client.res, 'delete', data);
+    });
+}
+
+// Keep idle event streams from being closed by proxies.
+setInterval(function () {
+    eventClients.forEach(function (client) {
+        client.res.write(': heartbeat\n\n');
+        client.res.flush();
+    });
+}, 1000 * 30);
+
+// Lets clients keep a response, that depends on the user, as long as it
+// is revalidated before each use. Answers 304 if it is still current.
+function revalidate(req, res, etag) {
+    res.set('Cache-Control', 'private, max-age=0, must-revalidate');
+    res.set('ETag', etag);
+
+    if (req.headers['if-none-match'] === etag) {
+        res.send(304);
+        return true;
+    }
+
+    return false;
+}
+
 app.get('/', function (req, res) {
-    res.json({
+    var body = JSON.stringify({
         user: req.user,
         groups: req.groups,
         _csrf: req.csrf
     });
+
+    if (revalidate(req, res, '"' + crypto.createHash('sha1').update(body).digest('hex') + '"')) {
+        return;
+    }
+
+    res.type('json').send(body);
+});
+
+app.get('/stats', function (req, res) {
+    if (!req.library_admin) {
+        return res.send(403);
+    }
+
+    res.set('Cache-Control', 'no-store');
+    res.json({
+        since: stats.since,
+        connections: stats.connections,
+        open: stats.open,
+        requests: stats.requests,
+        requestsPerConnection: stats.requestsPerConnection,
+        keepAliveTimeout: keepAliveTimeout
+    });
+});
+
+app.get('/events', function (req, res) {
+    res.set('Content-Type', 'text/event-stream');
+    res.set('Cache-Control', 'no-cache');
+    res.write('retry: 5000\n\n');
+    res.flush();
+
+    var client = { req: req, res: res };
+    eventClients.push(client);
+
+    req.on('close', function () {
+        var index = eventClients.indexOf(client);
+        if (index !== -1) {
+            eventClients.splice(index, 1);
+        }
+    });
 });
 
 app.get('/users/', function (req, res) {
@@ -224,30 +772,91 @@ app.get('/users/', function (req, res) {
         return res.send(403);
     }
 
-    res.setHeader('Content-Type', 'text/plain');
-    var users = childProcess.spawn(usersHook);
-    users.stdout.pipe(res);
+    loadUsers(function (directory) {
+        if (revalidate(req, res, directory.etag)) {
+            return;
+        }
+
+        var prefix = (req.query.prefix || '').toLowerCase();
+        var limit = parseInt(req.query.limit, 10);
+
+        var start = 0, end = directory.users.length;
+        if (prefix) {
+            start = lowerBound(directory.keys, prefix);
+            end = lowerBound(directory.keys, prefix + '\uffff');
+        }
+
+        res.set('X-Total-Count', end - start);
+        if (limit >= 0) {
+            end = Math.min(end, start + limit);
+        }
+
+        res.setHeader('Content-Type', 'text/plain');
+        res.send(directory.users.slice(start, end).map(function (user) {
+            return user + '\n';
+        }).join(''));
+    });
 });
 
 app.get('/books/', function (req, res) {
-    Book.find(function (err, books) {
+    // Read the revision first, so that changes made while the books are
+    // being collected will be sent again with the next delta.
+    currentRevision(function (err, revision) {
         if (err) throw err;
 
-        var etag = 0;
-        var response = { }
+        // The revision is a strong validator for the whole catalogue.
+        var etag = '"' + revision + '"';
+        res.set('ETag', etag);
+        res.set('X-Revision', revision);
 
-        for (var i = 0; i < books.length; i++) {
-            etag ^= books[i].etag;
+        if (req.headers['if-none-match'] === etag) {
+            return res.send(304);
+        }
 
-            response[books[i].id] = books[i].toObject({ virtuals: true });
+        var since = parseInt(req.query.since, 10);
+        if (isNaN(since) || since < 0 || since > revision) {
+            since = null;
+        }
 
-            if (!req.library_lend) {
-                delete response[books[i].id].lending;
-            }
+        var query = since === null ? { } : { revision: { $gt: since } };
+
+        // Full lists can be fetched in pages of books with ascending ids.
+        var after = parseInt(req.query.after, 10);
+        var limit = parseInt(req.query.limit, 10);
+        if (since === null && !isNaN(after)) {
+            query._id = { $gt: after };
         }
 
-        res.set('ETag', etag);
-        res.json(response);
+        var find = Book.find(query).lean();
+        if (since === null && limit > 0) {
+            find = find.sort({ _id: 1 }).limit(limit);
+        }
+
+        if (since === null) {
+            return streamBooks(find.cursor(), req, res);
+        }
+
+        find.exec(function (err, books) {
+            if (err) throw err;
+
+            var response = { }
+
+            for (var i = 0; i < books.length; i++) {
+                response[books[i]._id] = toClient(books[i], req);
+            }
+
+            Tombstone.find({ revision: { $gt: since } }, function (err, tombstones) {
+                if (err) throw err;
+
+                res.set('X-Since', since);
+                res.json({
+                    books: response,
+                    deleted: tombstones.map(function (tombstone) {
+                        return tombstone._id;
+                    })
+                });
+            });
+        });
     });
 });
 
@@ -273,33 +882,40 @@ app.post('/books/', function (req, res) {
     book.edition = req.body.edition;
     book.lendable = req.body.lendable;
 
-    book.save(function (err) {
-        if (err) {
-            console.log(err);
-            res.send(400, err);
-        } else {
-            res.set('ETag', book.etag);
-            res.json(book.toObject({ virtuals: true }));
-        }
+    nextRevision(function (err, revision) {
+        if (err) throw err;
+
+        book.revision = revision;
+
+        book.save(function (err) {
+            finishRevision(revision);
+
+            if (err) {
+                console.log(err);
+                res.send(400, err);
+            } else {
+                res.set('ETag', book.etag);
+                res.json(book.toObject({ virtuals: true }));
+                broadcastBook(book);
+            }
+        });
     });
 });
 
 app.get('/books/:id/', function (req, res) {
-    Book.findById(req.params.id, function (err, book) {
+    Book.findById(req.params.id).lean().exec(function (err, book) {
         if (err) throw err;
 
         if (!book) {
             return res.send(404);
         }
 
-        var response = book.toObject({ virtuals: true });
-
-        if (!req.library_lend) {
-            delete response.lending;
+        // The etag alone is too short to tell all versions apart.
+        if (revalidate(req, res, '"' + book.etag + '-' + book.revision + '"')) {
+            return;
         }
 
-        res.set('ETag', book.etag);
-        res.json(response);
+        res.json(toClient(book, req));
     });
 });
 
@@ -334,19 +950,23 @@ app.put('/books/:id/', function (req, res) {
         book.edition = req.body.edition;
         book.lendable = req.body.lendable;
 
-        book.save(function (err) {
-            if (err) {
-                console.log(err);
-                return res.send(400, err);
-            }
+        nextRevision(function (err, revision) {
+            if (err) throw err;
 
-            response = book.toObject({ virtuals: true });
-            if (!req.library_lend) {
-                delete response.lending;
-            }
+            book.revision = revision;
+
+            book.save(function (err) {
+                finishRevision(revision);
 
-            res.set('ETag', book.etag);
-            res.json(response);
+                if (err) {
+                    console.log(err);
+                    return res.send(400, err);
+                }
+
+                res.set('ETag', book.etag);
+                res.json(toClient(book.toObject(), req));
+                broadcastBook(book);
+            });
         });
     });
 });
@@ -363,9 +983,21 @@ app.delete('/books/:id/', function (req, res) {
             return res.send(403);
         }
 
-        book.remove(function (err, book) {
+        nextRevision(function (err, revision) {
             if (err) throw err;
-            return res.send(204);
+
+            book.remove(function (err, book) {
+                if (err) throw err;
+
+                Tombstone.findByIdAndUpdate(book._id, { revision: revision }, {
+                    upsert: true
+                }, function (err) {
+                    finishRevision(revision);
+                    if (err) throw err;
+                    res.send(204);
+                    broadcastDelete(book._id, revision);
+                });
+            });
         });
     });
 });
@@ -423,14 +1055,23 @@ app.post('/books/:id/lending', function (req, res) {
         book.lending.user = req.body.user;
         book.lending.days = parseInt(req.body.days, 10) || 14;
 
-        book.save(function (err) {
-            if (err) {
-                console.log(err);
-                return res.send(400, err);
-            }
+        nextRevision(function (err, revision) {
+            if (err) throw err;
+
+            book.revision = revision;
 
-            res.set('ETag', book.etag);
-            res.json(book.lending);
+            book.save(function (err) {
+                finishRevision(revision);
+
+                if (err) {
+                    console.log(err);
+                    return res.send(400, err);
+                }
+
+                res.set('ETag', book.etag);
+                res.json(book.lending);
+                broadcastBook(book);
+            });
         });
     });
 });
@@ -451,24 +1092,155 @@ app.delete('/books/:id/lending', function (req, res) {
             return res.send(403);
         }
 
+        if (req.query.etag && req.query.etag != book.etag) {
+            return res.send(409);
+        }
+
         book.etag = crypto.randomBytes(2).readUInt16BE(0);
         book.lending.user = null;
         book.lending.since = null;
         book.lending.days = null;
 
-        book.save(function (err) {
-            if (err) {
-                console.log(err);
-                return res.send(400, err);
-            } else {
-                res.set('ETag', book.etag);
-                return res.send(204);
+        nextRevision(function (err, revision) {
+            if (err) throw err;
+
+            book.revision = revision;
+
+            book.save(function (err) {
+                finishRevision(revision);
+
+                if (err) {
+                    console.log(err);
+                    return res.send(400, err);
+                } else {
+                    res.set('ETag', book.etag);
+                    res.send(204);
+                    broadcastBook(book);
+                }
+            });
+        });
+    });
+});
+
+app.post('/lendings/', function (req, res) {
+    if (!req.library_lend) {
+        return res.send(403);
+    }
+
+    var items = req.body && req.body.lendings;
+    if (!Array.isArray(items) || !items.length) {
+        return res.send(400);
+    }
+
+    var ids = items.map(function (item) {
+        return parseInt(item && item.id, 10);
+    });
+
+    // Fetch all books in one query and check each lending like a single
+    // POST /books/:id/lending would.
+    Book.find({ _id: { $in: ids.filter(function (id) { return !isNaN(id); }) } }, function (err, books) {
+        if (err) throw err;
+
+        var byId = { };
+        books.forEach(function (book) {
+            byId[book._id] = book;
+        });
+
+        var seen = { };
+        var results = items.map(function (item, i) {
+            var id = ids[i];
+            var book = byId[id];
+
+            if (!book) {
+                return { id: id, status: 404 };
+            }
+
+            if (seen[id] || (item.etag && item.etag != book.etag)) {
+                return { id: id, status: 409 };
+            }
+
+            if (book.lent && book.lending.user !== item.user) {
+                return { id: id, status: 412 };
+            }
+
+            if (!item.user) {
+                return { id: id, status: 400 };
             }
+
+            seen[id] = true;
+
+            if (book.lending.user !== item.user) {
+                book.lending.since = new Date();
+            }
+
+            book.etag = crypto.randomBytes(2).readUInt16BE(0);
+            book.lending.user = item.user;
+            book.lending.days = parseInt(item.days, 10) || 14;
+
+            return { id: id, status: 200 };
+        });
+
+        var pending = results.filter(function (result) {
+            return result.status === 200;
+        });
+
+        if (!pending.length) {
+            return res.json(results);
+        }
+
+        // All lendings of the batch share one revision.
+        nextRevision(function (err, revision) {
+            if (err) throw err;
+
+            var remaining = pending.length;
+
+            pending.forEach(function (result) {
+                var book = byId[result.id];
+                book.revision = revision;
+
+                book.save(function (err) {
+                    if (err) {
+                        console.log(err);
+                        result.status = 400;
+                    } else {
+                        result.etag = book.etag;
+                        result.lending = book.lending;
+                        broadcastBook(book);
+                    }
+
+                    if (--remaining === 0) {
+                        finishRevision(revision);
+                        res.json(results);
+                    }
+                });
+            });
         });
     });
 });
 
+// Keep idle connections open longer than the default of 5 seconds, so
+// that clients at the lending desk can reuse them between requests.
+var keepAliveTimeout = envSeconds('KEEP_ALIVE_TIMEOUT', 60);
+
 var port = parseInt(process.env.PORT) || 5000;
-app.listen(port, function () {
+var server = app.listen(port, function () {
     console.log('Listening on port ' + port + ' ...');
 });
+server.keepAliveTimeout = keepAliveTimeout;
+server.headersTimeout = keepAliveTimeout + 1000;
+
+server.on('connection', function (socket) {
+    stats.connections++;
+    stats.open++;
+
+    socket.on('close', function () {
+        var requests = socket.libraryRequests || 0;
+        var bucket = requests ? 1 : 0;
+        while (bucket && bucket * 2 <= requests) {
+            bucket *= 2;
+        }
+
+        stats.open--;
+        stats.requestsPerConnection[bucket] = (stats.requestsPerConnection[bucket] || 0) + 1;
+    });
+});